@@ -0,0 +1,316 @@
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import socket
+import stat
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import Counter
+from ldap.controls import SimplePagedResultsControl
+import requests
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _search_host(search, host):
+    """ Evaluate the few foreman search clauses used by the tools, joined by and, then by or """
+    return all(_search_any(re.sub(r'^\((.*)\)$', r'\1', part), host) for part in search.split(' and '))
+
+
+def _search_any(search, host):
+    for clause in search.split(' or '):
+        after = re.match(r'^id > (\d+)$', clause)
+        older = re.match(r'^last_report < "(\d+) hours ago"$', clause)
+        if older:
+            limit = datetime.datetime.utcnow() - datetime.timedelta(hours=int(older.group(1)))
+            if host['last_report'] and datetime.datetime.strptime(host['last_report'], DATE_FORMAT) < limit:
+                return True
+        elif after:
+            if host['id'] > int(after.group(1)):
+                return True
+        elif clause == 'not has last_report':
+            if not host['last_report']:
+                return True
+        else:
+            raise ValueError('Unsupported search {}'.format(clause))
+    return False
+
+
+class _ForemanServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ForemanHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, query, results):
+        per_page = min(int(query.get('per_page', ['20'])[0]), self.server.max_per_page)
+        page = int(query.get('page', ['1'])[0])
+        return {'total': len(results), 'subtotal': len(results), 'page': page, 'per_page': per_page,
+                'results': results[(page - 1) * per_page:page * per_page]}
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/_bench/stats':
+            return self._reply(200, dict(self.server.calls))
+        self.server.count('GET ' + re.sub(r'/\d+$', '/:id', url.path))
+        time.sleep(self.server.latency)
+
+        if url.path == '/api/hosts':
+            with self.server.lock:
+                hosts = list(self.server.hosts.values())
+            total = len(hosts)
+            if query.get('search'):
+                try:
+                    hosts = [h for h in hosts if _search_host(query['search'][0], h)]
+                except ValueError as e:
+                    return self._reply(400, {'error': str(e)})
+            if query.get('order'):
+                field, direction = query['order'][0].split()
+                hosts.sort(key=lambda h: h[field], reverse=direction.upper() == 'DESC')
+            page = self._page(query, hosts)
+            page['total'] = total
+            return self._reply(200, page)
+        elif url.path == '/api/fact_values':
+            hosts = sorted(self.server.facts)
+            wanted = re.search(r'host \^ \(([^)]*)\)', query.get('search', [''])[0])
+            if wanted:
+                names = set(wanted.group(1).split(','))
+                hosts = [h for h in hosts if h in names]
+            # Foreman pages the fact values by host
+            page = self._page(query, hosts)
+            page['results'] = {host: self.server.facts[host] for host in page['results']}
+            return self._reply(200, page)
+        self._reply(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        url = urlparse.urlparse(self.path)
+        self.server.count('DELETE ' + re.sub(r'/\d+$', '/:id', url.path))
+        time.sleep(self.server.latency)
+
+        match = re.match(r'^/api/hosts/(\d+)$', url.path)
+        with self.server.lock:
+            host = self.server.hosts.pop(int(match.group(1)), None) if match else None
+        if host is None:
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, host)
+
+
+class FakeForeman(object):
+    def __init__(self, hosts, facts, latency=0.0, max_per_page=1000):
+        """
+        Foreman API serving a fleet from a separate process, so that it does not share the GIL of the benchmarked code
+        :param hosts: Foreman hosts
+        :param facts: A dict certname -> {'ec2_instance_id': id}
+        :param latency: Time in seconds added to each request
+        :param max_per_page: Maximum number of results of a page whatever the per_page asked
+        """
+        self._server = _ForemanServer(('127.0.0.1', 0), _ForemanHandler)
+        self._server.hosts = {host['id']: host for host in sorted(hosts, key=lambda h: h['name'])}
+        self._server.facts = facts
+        self._server.latency = latency
+        self._server.max_per_page = max_per_page
+        self._server.lock = threading.Lock()
+        self._server.calls = Counter()
+
+        def count(call):
+            with self._server.lock:
+                self._server.calls[call] += 1
+        self._server.count = count
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._process = None
+
+    def start(self):
+        self._process = multiprocessing.Process(target=self._server.serve_forever)
+        self._process.daemon = True
+        self._process.start()
+        self._server.socket.close()
+
+    def calls(self):
+        return requests.get(self.url + '/_bench/stats').json()
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+class _Paginator(object):
+    def __init__(self, ec2, operation):
+        self._ec2 = ec2
+        self._operation = operation
+
+    def paginate(self, Filters=(), PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        results = self._ec2.search(self._operation, Filters)
+        for i in range(0, max(len(results), 1), page_size):
+            yield self._ec2.page(self._operation, results[i:i + page_size])
+
+
+class FakeEc2(object):
+    # Filters answered with an index instead of a scan of every instance
+    indexed_filters = {'instance-id': 'InstanceId', 'private-ip-address': 'PrivateIpAddress'}
+
+    def __init__(self, instances, latency=0.0):
+        """
+        EC2 client answering describe_instances from memory
+        :param instances: EC2 instances
+        :param latency: Time in seconds added to each call or page
+        """
+        self.instances = instances
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._index = {}
+        for filter_name, key in self.indexed_filters.items():
+            index = self._index[filter_name] = {}
+            for instance in instances:
+                index.setdefault(instance[key], []).append(instance)
+
+    def get_paginator(self, operation):
+        return _Paginator(self, operation)
+
+    def describe_instances(self, Filters=(), **kwargs):
+        return self.page('describe_instances', self.search('describe_instances', Filters))
+
+    def search(self, operation, filters):
+        candidates = None
+        for f in filters:
+            if f['Name'] in self._index:
+                candidates = [i for value in f['Values'] for i in self._index[f['Name']].get(value, [])]
+        if candidates is None:
+            candidates = self.instances
+        return [i for i in candidates if all(self._match(i, f) for f in filters)]
+
+    def page(self, operation, instances):
+        with self._lock:
+            self.calls[operation] += 1
+        time.sleep(self.latency)
+        return {'Reservations': [{'Instances': [i]} for i in instances]}
+
+    def _match(self, instance, f):
+        if f['Name'] in self.indexed_filters:
+            return instance[self.indexed_filters[f['Name']]] in f['Values']
+        elif f['Name'] == 'instance-state-name':
+            return instance['State']['Name'] in f['Values']
+        elif f['Name'] == 'tag-key':
+            return any(tag['Key'] in f['Values'] for tag in instance.get('Tags', []))
+        raise ValueError('Unsupported filter {}'.format(f['Name']))
+
+
+class FakeLdapObject(object):
+    def __init__(self, computers, latency=0.0):
+        """
+        In memory directory answering the ldap calls made by AwsDs
+        :param computers: (dn, attributes) of the computers
+        :param latency: Time in seconds added to each operation
+        """
+        self.entries = dict(computers)
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._results = {}
+        self._msgid = 0
+
+    def _operation(self, name, result=None):
+        with self._lock:
+            self.calls[name] += 1
+            self._msgid += 1
+            self._results[self._msgid] = result
+            msgid = self._msgid
+        time.sleep(self.latency)
+        return msgid
+
+    def simple_bind_s(self, who, cred):
+        self._operation('bind')
+
+    def search_ext(self, base, scope, search_filter, attrlist=None, serverctrls=None, timeout=-1):
+        page_control = serverctrls[0]
+        start = int(page_control.cookie or 0)
+        with self._lock:
+            dns = sorted(self.entries)[start:start + page_control.size]
+            entries = [(dn, {k: v for k, v in self.entries[dn].items() if not attrlist or k in attrlist}) for dn in dns]
+        cookie = str(start + len(dns)) if start + len(dns) < len(self.entries) else ''
+        return self._operation('search', (entries, [SimplePagedResultsControl(True, size=page_control.size,
+                                                                              cookie=cookie)]))
+
+    def result3(self, msgid, all=1, timeout=None):
+        with self._lock:
+            entries, controls = self._results.pop(msgid)
+        return 101, entries, msgid, controls
+
+    def result(self, msgid, all=1, timeout=None):
+        with self._lock:
+            self._results.pop(msgid)
+        return 105, []
+
+    def delete_s(self, dn):
+        self._operation('delete')
+        with self._lock:
+            del self.entries[dn]
+
+    def add(self, dn, modlist):
+        cn = dn.split(",")[0].replace("CN=", "")
+        with self._lock:
+            self.entries[dn] = {'cn': [cn], 'sAMAccountName': [cn + '$'], 'distinguishedName': [dn]}
+        return self._operation('add')
+
+    def add_s(self, dn, modlist):
+        return self.result(self.add(dn, modlist))
+
+
+class FakeResolver(object):
+    def __init__(self, dns, latency=0.0):
+        """
+        :param dns: A dict hostname -> ip of the names which resolve
+        :param latency: Time in seconds of each lookup
+        """
+        self.dns = dns
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, hostname):
+        with self._lock:
+            self.calls['resolve'] += 1
+        time.sleep(self.latency)
+        try:
+            return self.dns[hostname]
+        except KeyError:
+            raise socket.gaierror(socket.EAI_NONAME, 'Unknown host {}'.format(hostname))
+
+
+FAKE_PUPPET = '''#!{python}
+import os
+import sys
+import time
+time.sleep(float(os.environ.get('BENCH_PUPPET_LATENCY', '0')))
+with open(os.environ['BENCH_PUPPET_LOG'], 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+'''
+
+
+def write_fake_puppet(path):
+    """ Write a puppet executable which only logs its arguments in $BENCH_PUPPET_LOG """
+    with open(path, 'w') as f:
+        f.write(FAKE_PUPPET.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
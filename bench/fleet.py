@@ -0,0 +1,78 @@
+import datetime
+import random
+
+DOMAIN = 'bench.cloud.coveo.com'
+COMPUTERS_BASE_DN = 'OU=Computers,DC=bench,DC=cloud,DC=coveo,DC=com'
+PREFIXES = ['ndev', 'nsta', 'nprd', 'nqa', 'win']
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+class Fleet(object):
+    def __init__(self, size, seed=0, stale_ratio=0.2, terminated_ratio=0.75, orphan_ratio=0.05, unjoined_ratio=0.02):
+        """
+        Synthesize the foreman, EC2, DS and puppet inventories of a fleet, the same size and seed always give the same fleet
+        :param size: Number of hosts in foreman
+        :param stale_ratio: Part of the hosts without a recent puppet report
+        :param terminated_ratio: Part of the stale hosts whose instance is terminated
+        :param orphan_ratio: Part of the fleet left in the DS and puppet after its host was removed from foreman
+        :param unjoined_ratio: Part of the windows instances missing from the DS
+        """
+        rand = random.Random(seed)
+        now = datetime.datetime.utcnow()
+        fresh = (now - datetime.timedelta(hours=1)).strftime(DATE_FORMAT)
+        stale = (now - datetime.timedelta(days=3)).strftime(DATE_FORMAT)
+
+        self.hosts = []
+        self.facts = {}
+        self.instances = []
+        self.computers = []
+        self.certificates = []
+        self.dns = {}
+
+        for i in range(size):
+            name = '{}-bench{:06d}'.format(PREFIXES[i % len(PREFIXES)], i)
+            certname = '{}.{}'.format(name, DOMAIN)
+            ip = '10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+            mac = '02:00:00:{:02x}:{:02x}:{:02x}'.format(i // 65536 % 256, i // 256 % 256, i % 256)
+            instance_id = 'i-{:017x}'.format(i)
+            is_stale = rand.random() < stale_ratio
+            state = 'terminated' if is_stale and rand.random() < terminated_ratio else 'running'
+
+            self.hosts.append({
+                'id': i + 1, 'name': certname, 'certname': certname, 'ip': ip, 'mac': mac,
+                'last_compile': stale if is_stale else fresh, 'last_report': stale if is_stale else fresh,
+                'created_at': stale,
+            })
+            # Most hosts have their instance id fact, the others are looked up by ip
+            if rand.random() < 0.7:
+                self.facts[certname] = {'ec2_instance_id': instance_id}
+            self.instances.append({
+                'InstanceId': instance_id, 'PrivateIpAddress': ip, 'MacAddress': mac,
+                'State': {'Name': state}, 'Tags': [{'Key': 'Name', 'Value': name}],
+            })
+            if not (name.startswith('win') and rand.random() < unjoined_ratio):
+                self.computers.append(computer(name))
+            self.certificates.append(certname)
+
+        # Leftovers of hosts already removed from foreman, half of them still resolve to a terminated instance
+        for i in range(int(size * orphan_ratio)):
+            name = 'nprd-orphan{:06d}'.format(i)
+            self.computers.append(computer(name))
+            self.certificates.append('{}.{}'.format(name, DOMAIN))
+            if i % 2:
+                ip = '172.16.{}.{}'.format(i // 256 % 256, i % 256)
+                self.dns['{}.{}'.format(name, DOMAIN)] = ip
+                self.instances.append({
+                    'InstanceId': 'i-orphan{:09x}'.format(i), 'PrivateIpAddress': ip,
+                    'MacAddress': '02:01:00:00:{:02x}:{:02x}'.format(i // 256 % 256, i % 256),
+                    'State': {'Name': 'terminated'}, 'Tags': [{'Key': 'Name', 'Value': name}],
+                })
+
+
+def computer(name):
+    dn = 'CN={},{}'.format(name.upper(), COMPUTERS_BASE_DN)
+    return dn, {
+        'cn': [name.upper()], 'dNSHostName': ['{}.{}'.format(name, DOMAIN)],
+        'sAMAccountName': [name.upper() + '$'], 'distinguishedName': [dn],
+    }
+
@@ -0,0 +1,162 @@
+import click
+import functools
+import imp
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from fakes import FakeEc2, FakeForeman, FakeLdapObject, FakeResolver, write_fake_puppet
+from fleet import COMPUTERS_BASE_DN, DOMAIN, Fleet
+
+INSTALL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'install')
+COMMANDS = ['clean_old_host', 'clean_ds', 'clean_old_certificates', 'check_join']
+
+
+def peak_rss():
+    """ Peak resident memory of the process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def fleet_options(command):
+    for option in reversed([
+        click.option('--foreman_latency', default=0.02, help="Seconds added to each foreman request"),
+        click.option('--ec2_latency', default=0.05, help="Seconds added to each EC2 call"),
+        click.option('--ldap_latency', default=0.005, help="Seconds added to each ldap operation"),
+        click.option('--dns_latency', default=0.001, help="Seconds of each DNS lookup"),
+        click.option('--puppet_latency', default=0.05, help="Seconds of each puppet run"),
+        click.option('--per_page', default=1000, help="Maximum number of results of a foreman page"),
+        click.option('--auto_heal_rate', default=50, help="auto_heal_rate of check-join"),
+        click.option('--seed', default=0, help="Seed of the synthesized fleet"),
+    ]):
+        command = option(command)
+    return command
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--command', type=click.Choice(COMMANDS), required=True)
+@click.option('--size', default=1000, help="Number of hosts of the fleet")
+@click.option('--result_file', required=True, help="Path of the json file receiving the measures")
+@fleet_options
+def measure(command, size, result_file, foreman_latency, ec2_latency, ldap_latency, dns_latency, puppet_latency,
+            per_page, auto_heal_rate, seed):
+    """ Run a single command against the fakes, it is run in its own process to measure its peak memory """
+    fleet = Fleet(size, seed)
+    foreman = FakeForeman(fleet.hosts, fleet.facts, latency=foreman_latency, max_per_page=per_page)
+    # Fork the foreman process before any thread is started
+    foreman.start()
+
+    workdir = tempfile.mkdtemp(prefix='foreman-cleaner-bench')
+    puppet_log = os.path.join(workdir, 'puppet.log')
+    open(puppet_log, 'w').close()
+    certificates_file = os.path.join(workdir, 'certificates.json')
+    with open(certificates_file, 'w') as f:
+        json.dump(fleet.certificates, f)
+    config_file = os.path.join(workdir, 'config.yaml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump({'domain_name': DOMAIN, 'domain_computer_dn': COMPUTERS_BASE_DN, 'domain_user': 'bench',
+                        'domain_password': 'bench', 'search_filters': ['win'], 'auto_heal': True,
+                        'auto_heal_rate': auto_heal_rate}, f)
+
+    os.environ.update({
+        'FOREMAN_URL': foreman.url, 'FOREMAN_USER': 'bench', 'FOREMAN_PASSWORD': 'bench',
+        'FOREMANPROXY_HOST': '127.0.0.1', 'FOREMAN_CLEAN_DELAY': '24',
+        'LDAP_HOST': DOMAIN, 'COMPUTER_DN': COMPUTERS_BASE_DN, 'DS_USER': 'bench', 'DS_PASSWORD': 'bench',
+        'CERT_BACKEND': 'puppet', 'PUPPET_BIN': write_fake_puppet(os.path.join(workdir, 'puppet')),
+        'BENCH_PUPPET_LOG': puppet_log, 'BENCH_PUPPET_LATENCY': str(puppet_latency),
+    })
+    # Never push the benchmark runs to a real gateway
+    os.environ.pop('PROMETHEUS_ENDPOINT', None)
+    sys.path.insert(0, INSTALL_DIR)
+
+    import awsutils
+    import dnsutils
+    ec2 = FakeEc2(fleet.instances, latency=ec2_latency)
+    awsutils.set_client(ec2)
+    directory = FakeLdapObject(fleet.computers, latency=ldap_latency)
+    awsutils.ReconnectLDAPObject = lambda uri, **kwargs: directory
+    resolver = FakeResolver(fleet.dns, latency=dns_latency)
+
+    host_cleaner = imp.load_source('host_cleaner', os.path.join(INSTALL_DIR, 'host-cleaner.py'))
+    host_cleaner.resolve_hostnames = functools.partial(dnsutils.resolve_hostnames, resolve=resolver)
+    import check_windows
+    commands = {
+        'clean_old_host': lambda: host_cleaner.clean_old_host.callback(),
+        'clean_ds': lambda: host_cleaner.clean_ds.callback(),
+        'clean_old_certificates': lambda: host_cleaner.clean_old_certificates.callback(
+            json_file=certificates_file, check_on_fs=False),
+        'check_join': lambda: check_windows.check_join.callback(config_file=config_file),
+    }
+
+    baseline = peak_rss()
+    start = time.time()
+    commands[command]()
+    wall_time = time.time() - start
+    peak = peak_rss()
+
+    calls = {}
+    calls.update(('foreman {}'.format(k), v) for k, v in foreman.calls().items())
+    calls.update(('ec2 {}'.format(k), v) for k, v in ec2.calls.items())
+    calls.update(('ldap {}'.format(k), v) for k, v in directory.calls.items())
+    calls.update(('dns {}'.format(k), v) for k, v in resolver.calls.items())
+    with open(puppet_log) as f:
+        puppet_runs = sum(1 for _ in f)
+    if puppet_runs:
+        calls['puppet cert clean'] = puppet_runs
+    foreman.stop()
+    shutil.rmtree(workdir)
+
+    with open(result_file, 'w') as f:
+        json.dump({'command': command, 'size': size, 'wall_time': wall_time, 'peak_rss_mb': peak,
+                   'rss_delta_mb': peak - baseline, 'calls': calls}, f)
+
+
+@main.command()
+@click.option('--sizes', default='1000,10000,50000', help="Comma separated fleet sizes")
+@click.option('--commands', default=','.join(COMMANDS), help="Comma separated commands to run")
+@click.option('--output', default=None, help="Path of a json file receiving every measure")
+@click.option('--verbose', is_flag=True, help="Show the output of the commands")
+@fleet_options
+def run(sizes, commands, output, verbose, **options):
+    """ Run every command against fleets of every size and report wall time, API calls and peak memory """
+    results = []
+    devnull = open(os.devnull, 'w')
+    click.echo('{:<24}{:>8}{:>10}{:>10}{:>12}{:>12}'.format('command', 'hosts', 'wall (s)', 'calls', 'peak (MB)',
+                                                            'delta (MB)'))
+    for size in [int(s) for s in sizes.split(',')]:
+        for command in commands.split(','):
+            result_file = tempfile.mktemp(suffix='.json')
+            args = [sys.executable, os.path.abspath(__file__), 'measure', '--command', command, '--size', str(size),
+                    '--result_file', result_file]
+            for name, value in options.items():
+                args += ['--{}'.format(name), str(value)]
+            if subprocess.call(args, stdout=None if verbose else devnull, stderr=None if verbose else devnull):
+                click.echo('{:<24}{:>8}    failed, run it again with --verbose'.format(command, size))
+                continue
+            with open(result_file) as f:
+                result = json.load(f)
+            os.remove(result_file)
+            results.append(result)
+            click.echo('{:<24}{:>8}{:>10.2f}{:>10}{:>12.1f}{:>12.1f}'.format(
+                command, size, result['wall_time'], sum(result['calls'].values()), result['peak_rss_mb'],
+                result['rss_delta_mb']))
+            for call, count in sorted(result['calls'].items()):
+                click.echo('    {:<44}{:>8}'.format(call, count))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
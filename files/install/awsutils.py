@@ -1,9 +1,35 @@
 import ldap
 import ldap.modlist
+from ldap.controls import SimplePagedResultsControl
+from ldap.ldapobject import ReconnectLDAPObject
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+import datetime
+from collections import deque
 import re
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from prefixes import SortedPrefixIndex
+from metrics import track
+import profiling
+
+
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '20'))
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '10'))
+
+# Clients shared by every thread, by (kind, service, region, role arn)
+_clients = {}
+_clients_lock = threading.RLock()
+_session = None
+# Sessions of assumed roles with the expiration of their credentials
+_role_sessions = {}
+
+EC2_INVENTORY_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# Only the attributes used by the tools are requested from the DS
+COMPUTER_ATTRIBUTES = ['cn', 'dNSHostName', 'sAMAccountName', 'distinguishedName']
 
 
 class NotFound(Exception):
@@ -16,52 +42,134 @@ class TooManyResult(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
+def connect_ldap(ldap_host, bind_user_dn, bind_password, secure=False):
+    """
+    Return a bound ldap connection, it can be shared by several AwsDs
+    :param secure: Use ldap or ldaps (True or False)
+    """
+    protocol = 'ldap'
+    if secure:
+        protocol = 'ldaps'
+
+    # Reconnect and bind again transparently when a long lived connection is dropped by the server
+    con = ReconnectLDAPObject("{}://{}".format(protocol, ldap_host), retry_max=3, retry_delay=5)
+    con.simple_bind_s(bind_user_dn, bind_password)
+    return con
+
+
 class AwsDs(object):
-    def __init__(self, ldap_host, computers_base_dn, bind_user_dn, bind_password, secure=False):
+    def __init__(self, ldap_host, computers_base_dn, bind_user_dn, bind_password, secure=False, connection=None):
         """
         :param ldap_host: Ldap server hostname or ip
         :param base_dn: The root dn of the directory. Ex: "OU=Computers,DC=example,DC=com"
         :param bind_user_dn: User's dn used to bind with ad. Ex: "uid=toto,ou=users,dc=example,dc=com"
         :param bind_password: User's password for the binding
         :param secure: Use ldap or ldaps (True or False)
+        :param connection: A bound ldap connection from connect_ldap, shared with other AwsDs. The computers loaded
+                           and indexed by this AwsDs are never shared. A new connection is opened when not given
         """
-        protocol = 'ldap'
-        if secure:
-            protocol = 'ldaps'
-
-        self._con = ldap.initialize("{}://{}".format(protocol, ldap_host))
-        self._con.simple_bind(bind_user_dn, bind_password)
+        self._con = connection or connect_ldap(ldap_host, bind_user_dn, bind_password, secure)
 
         self.computers_base_dn = computers_base_dn
         self._computers = []
+        self._by_dn = None
+        self._by_cn = None
+        self._by_dns = None
+        self._index_lock = threading.RLock()
 
     @property
     def computers(self):
         if not self._computers:
-            self._computers = self._con.search_st(self.computers_base_dn, ldap.SCOPE_SUBTREE, '(objectclass=computer)',[], 0, 500)
+            self._computers = list(self.iter_computers())
         return self._computers
 
-    def delete_computer(self, hostname):
+    @computers.setter
+    def computers(self, computers):
+        with self._index_lock:
+            self._computers = computers
+            self._by_dn = None
+
+    def iter_computers(self, search_filter='(objectclass=computer)', page_size=500, timeout=60,
+                       attributes=COMPUTER_ATTRIBUTES):
+        """
+        Yield (dn, attributes) of every computer, using the simple paged results control to stay under the
+        server size limit.
+        :param search_filter: Ldap filter of the search
+        :param attributes: Attributes returned for each computer, ['1.1'] returns none of them
+        :param page_size: Number of entries returned by the DS per page
+        :param timeout: Timeout in seconds of each page
+        """
+        page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        while True:
+            with track('ldap', 'search'):
+                msgid = self._con.search_ext(self.computers_base_dn, ldap.SCOPE_SUBTREE, search_filter,
+                                             attributes, serverctrls=[page_control], timeout=timeout)
+                _, entries, _, controls = self._con.result3(msgid, timeout=timeout)
+                profiling.annotate(entries=len(entries))
+            for c_dn, attr in entries:
+                # Skip search references
+                if c_dn:
+                    yield c_dn, attr
+
+            cookies = [c.cookie for c in controls if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+            page_control.cookie = cookies[0]
+
+    def _build_index(self):
+        """ Index computers by dn, upper-case cn and lower-case dNSHostName to avoid scanning all of them on lookup """
+        with self._index_lock:
+            if self._by_dn is not None:
+                return
+            self._by_dn = {}
+            self._by_cn = {}
+            self._by_dns = SortedPrefixIndex()
+            for c_dn, attr in self.computers:
+                if c_dn:
+                    self._index(c_dn, attr)
+
+    def _index(self, dn, attr):
+        with self._index_lock:
+            self._by_dn[dn] = attr
+            self._by_cn.setdefault(attr['cn'][0].upper(), set()).add(dn)
+            if 'dNSHostName' in attr:
+                self._by_dns.add(attr['dNSHostName'][0].lower(), dn)
+
+    def _unindex(self, dn):
+        with self._index_lock:
+            attr = self._by_dn.pop(dn, None)
+            if attr is None:
+                return
+            self._by_cn[attr['cn'][0].upper()].discard(dn)
+            if 'dNSHostName' in attr:
+                self._by_dns.remove(attr['dNSHostName'][0].lower(), dn)
+
+    def find_computer(self, hostname):
+        """ Return the dn and attributes of the computer whose dNSHostName starts with hostname or whose cn match it """
+        self._build_index()
+
         cn = hostname.split('.')[0].upper()
-        computer_found = []
-        for c_dn, attr in self.computers:
-            if 'dNSHostName' in attr and re.match('^{}.*'.format(hostname.lower()), attr['dNSHostName'][0].lower()):
-                computer_found.append(attr)
-                continue
-            elif cn == attr['cn'][0].upper():
-                computer_found.append(attr)
+        with self._index_lock:
+            computer_found = set(self._by_dns.startswith(hostname.lower())) | self._by_cn.get(cn, set())
 
         if len(computer_found) > 1:
             raise TooManyResult("There is more than 1 result on DS lookup")
         elif not computer_found:
             raise NotFound("Host not found in DS")
-        else:
-            print("DS - delete : {} - {}".format(
-                computer_found[0]['sAMAccountName'][0], computer_found[0]['distinguishedName'][0]))
-            self._con.delete_s(computer_found[0]['distinguishedName'][0])
+        dn = computer_found.pop()
+        return dn, self._by_dn[dn]
 
-    def add_computer(self, dn):
+    def delete_computer(self, hostname):
+        dn, computer = self.find_computer(hostname)
+        print("DS - delete : {} - {}".format(
+            computer['sAMAccountName'][0], computer['distinguishedName'][0]))
+        with track('ldap', 'delete'):
+            self._con.delete_s(computer['distinguishedName'][0])
+        self._unindex(dn)
+        return dn
 
+    @staticmethod
+    def _computer_modlist(dn):
         cn = dn.split(",")[0].replace("CN=", "")
         modlist = {
             "objectClass": ['top', 'person', 'organizationalPerson', 'user', 'computer'],
@@ -70,74 +178,238 @@ class AwsDs(object):
             "userAccountControl": '4096',
             "SAMAccountName": cn+'$'
         }
+        return cn, ldap.modlist.addModlist(modlist)
 
-        result = self._con.add_s(dn, ldap.modlist.addModlist(modlist))
+    def _added(self, dn):
+        if self._by_dn is not None:
+            cn = dn.split(",")[0].replace("CN=", "")
+            self._index(dn, {'cn': [cn], 'sAMAccountName': [cn+'$'], 'distinguishedName': [dn]})
+
+    def add_computer(self, dn):
+        _, modlist = self._computer_modlist(dn)
+        with track('ldap', 'add'):
+            result = self._con.add_s(dn, modlist)
+        self._added(dn)
         return result
 
+    def add_computers(self, dns, limiter=None, max_in_flight=20, timeout=60):
+        """
+        Add many computers with asynchronous ldap operations, a computer which already exists counts as added
+        :param dns: Dn of the computers to add
+        :param limiter: A ratelimit.TokenBucket limiting the rate of the adds sent to the DS
+        :param max_in_flight: Maximum number of adds waiting for their result
+        :param timeout: Timeout in seconds of each add
+        :return: A dict dn -> None if the computer was added, else the exception raised
+        """
+        results = {}
+        pending = deque()
+        for dn in dns:
+            if limiter is not None:
+                limiter.acquire()
+            _, modlist = self._computer_modlist(dn)
+            try:
+                pending.append((self._con.add(dn, modlist), dn))
+            except ldap.LDAPError as e:
+                results[dn] = e
+                continue
+            if len(pending) >= max_in_flight:
+                self._add_result(pending.popleft(), results, timeout)
+        while pending:
+            self._add_result(pending.popleft(), results, timeout)
+        return results
 
-def get_ec2_instance_state(instance_id, ip=None, mac=None):
-    client = boto3.client('ec2')
-    state = 'terminated'
-    options = {"InstanceIds": [instance_id]}
-    if ip:
-        options = {"Filters": [
-            {
-                'Name': 'private-ip-address',
-                'Values': [ip]
-            },
-        ]}
-
-    try:
-        if instance_id or ip:
-            rsp = client.describe_instances(**options)
-            if rsp['Reservations']:
-                state = rsp['Reservations'][0]['Instances'][0]['State']['Name']
-        elif mac:
-            state = get_eni_status(mac=mac, client=client)
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+    def _add_result(self, operation, results, timeout):
+        msgid, dn = operation
+        try:
+            with track('ldap', 'add'):
+                self._con.result(msgid, all=1, timeout=timeout)
+        except ldap.ALREADY_EXISTS:
             pass
-        else:
-            raise e
-    return state
-
-
-def get_eni_status(mac, client=None):
-    if not client:
-        client = boto3.client('ec2')
-    state = 'terminated'
-    try:
-        response = client.describe_network_interfaces(
-            Filters=[
-                {
-                    'Name': 'mac-address',
-                    'Values': [mac]
-                },
-            ]
-        )
-
-        state = response["NetworkInterfaces"]["Status"]
-    except TypeError:
-        pass
-
-    return state
-
-
-def get_instances_from_ec2(domain_name):
-    client = boto3.resource('ec2')
+        except ldap.LDAPError as e:
+            results[dn] = e
+            return
+        self._added(dn)
+        results[dn] = None
+
+
+def _get_session(role_arn=None):
+    """ Return the default session, or a session with the credentials of an assumed role renewed before they expire """
+    global _session
+    if role_arn is None:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+    session, expiration = _role_sessions.get(role_arn, (None, None))
+    if session is None or expiration - datetime.datetime.now(expiration.tzinfo) < datetime.timedelta(minutes=5):
+        sts = _get('client', 'sts', None)
+        with track('sts', 'assume_role'):
+            credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='foreman-cleaner')['Credentials']
+        session = boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                        aws_secret_access_key=credentials['SecretAccessKey'],
+                                        aws_session_token=credentials['SessionToken'])
+        _role_sessions[role_arn] = (session, credentials['Expiration'])
+        # Clients of the previous session hold expired credentials
+        for key in [k for k in _clients if k[3] == role_arn]:
+            del _clients[key]
+    return session
+
+
+def _get(kind, service, region, role_arn=None):
+    # boto3 sessions are not thread safe, clients are created under the lock then shared
+    with _clients_lock:
+        session = _get_session(role_arn)
+        key = (kind, service, region, role_arn)
+        if key not in _clients:
+            create = getattr(session, kind)
+            _clients[key] = create(service, region_name=region, config=Config(
+                max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': 'adaptive'}))
+        return _clients[key]
+
+
+def get_client(service='ec2', region=None, role_arn=None):
+    """ Return the client of a service shared by the whole process, one per region and assumed role """
+    return _get('client', service, region, role_arn)
+
+
+def get_resource(service='ec2', region=None, role_arn=None):
+    """ Return the resource of a service shared by the whole process, one per region and assumed role """
+    return _get('resource', service, region, role_arn)
+
+
+def set_client(client, service='ec2', region=None, kind='client', role_arn=None):
+    """ Replace the shared client (or resource) of a service, used to stub AWS """
+    with _clients_lock:
+        _clients[(kind, service, region, role_arn)] = client
+
+
+def _annotate_size(response):
+    """ Add the size of a botocore response to the span of the call """
+    size = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('content-length')
+    if size is not None:
+        profiling.annotate(bytes=int(size))
+
+
+def _paginate(client, operation, **kwargs):
+    """ Yield the pages of an EC2 operation, each page being tracked as a call """
+    pages = iter(client.get_paginator(operation).paginate(**kwargs))
+    while True:
+        with track('ec2', operation):
+            page = next(pages, None)
+            if page is not None:
+                _annotate_size(page)
+        if page is None:
+            return
+        yield page
+
+
+def _chunks(values, size):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _private_ips(instance):
+    """ Every private ip of an instance, the private-ip-address filter also matches the secondary ones """
+    ips = [instance.get('PrivateIpAddress')]
+    for eni in instance.get('NetworkInterfaces', []):
+        ips.extend(address['PrivateIpAddress'] for address in eni.get('PrivateIpAddresses', []))
+    return ips
+
+
+class Ec2StateResolver(object):
+    """
+    Resolve the EC2 state of many hosts with a few batched calls instead of one
+    describe_instances call per host. Lookups are then answered from memory, a host
+    without instance id nor ip is considered terminated.
+    """
+    # Maximum number of values accepted by a single EC2 filter
+    chunk_size = 200
+
+    def __init__(self, client=None):
+        self._client = client or get_client('ec2')
+        self._by_id = {}
+        self._by_ip = {}
+        self._errors = {}
+
+    def resolve(self, instance_ids=(), ips=()):
+        """
+        :param instance_ids: EC2 instance ids to resolve
+        :param ips: Private ip addresses to resolve
+        """
+        self._describe_instances('instance-id', set(instance_ids) - set(self._by_id), self._by_id,
+                                 lambda i: [i['InstanceId']])
+        self._describe_instances('private-ip-address', set(ips) - set(self._by_ip), self._by_ip,
+                                 _private_ips)
+
+    def get_state(self, instance_id, ip=None):
+        if ip:
+            return self._lookup(self._by_ip, ip)
+        elif instance_id:
+            return self._lookup(self._by_id, instance_id)
+        return 'terminated'
+
+    def _lookup(self, states, key):
+        if key in self._errors:
+            raise self._errors[key]
+        return states.get(key, 'terminated')
+
+    def _describe_instances(self, filter_name, values, states, keys_of):
+        for chunk in _chunks(values, self.chunk_size):
+            try:
+                for page in _paginate(self._client, 'describe_instances',
+                                      Filters=[{'Name': filter_name, 'Values': chunk}]):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            for key in keys_of(instance):
+                                # Keep the first answer when several instances match
+                                states.setdefault(key, instance['State']['Name'])
+            except ClientError as e:
+                self._errors.update(dict.fromkeys(chunk, e))
+
+
+def _instance_name(tags):
+    name = ''
+    for tag in tags:
+        if tag['Key'] == 'opsworks:instance':
+            return tag['Value']
+        elif tag['Key'] == 'Name':
+            name = tag['Value']
+    return name
+
+
+def _get_region_instances(domain_name, region=None, role_arn=None):
+    client = get_client('ec2', region, role_arn)
     machine_names = {}
+    # Only named instances which still exist are listed
+    pages = _paginate(
+        client, 'describe_instances',
+        Filters=[{'Name': 'instance-state-name', 'Values': EC2_INVENTORY_STATES},
+                 {'Name': 'tag-key', 'Values': ['Name', 'opsworks:instance']}],
+        PaginationConfig={'PageSize': 1000})
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                name = _instance_name(instance.get('Tags', []))
+                if name:
+                    machine_names['{}.{}'.format(name.lower(), domain_name)] = {
+                        'status': instance['State']['Name'], 'cn': name.lower(),
+                        'id': instance['InstanceId'], 'ip': instance.get('PrivateIpAddress')}
+    return machine_names
 
-    for instance in client.instances.all():
-        name = ''
-        if instance.tags:
-            for tag in instance.tags:
-                if tag['Key'] == 'opsworks:instance':
-                    name = tag['Value']
-                    break
-                elif tag['Key'] == 'Name':
-                    name = tag['Value']
-            if name:
-                machine_names['{}.{}'.format(name.lower(), domain_name)] = \
-                    {'status': instance.state['Name'], 'cn': name.lower()}
 
+def get_instances_from_ec2(domain_name, regions=None, role_arns=None):
+    """
+    List the named instances of every region of every account in parallel
+    :param domain_name: Domain appended to the instance names
+    :param regions: Regions to list, the default region when not set
+    :param role_arns: Roles assumed to list other accounts, the current account when not set
+    :return: A dict name.domain -> {'status', 'cn', 'id', 'ip'}
+    """
+    targets = [(region, role_arn) for region in regions or [None] for role_arn in role_arns or [None]]
+    machine_names = {}
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        for instances in pool.map(lambda t: _get_region_instances(domain_name, *t), targets):
+            machine_names.update(instances)
     return machine_names
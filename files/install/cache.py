@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# The cache is disabled when no path is given
+CACHE_PATH = os.environ.get('CACHE_PATH')
+CACHE_FULL_TTL = int(os.getenv('CACHE_FULL_TTL', '86400'))
+CACHE_FACTS_TTL = int(os.getenv('CACHE_FACTS_TTL', '3600'))
+CACHE_DS_TTL = int(os.getenv('CACHE_DS_TTL', '0'))
+CACHE_EC2_TTL = int(os.getenv('CACHE_EC2_TTL', '300'))
+
+# Changes are fetched from a bit before the last sync to absorb clock skew between us and the backends
+SYNC_MARGIN = 900
+
+
+def ldap_time(timestamp):
+    return time.strftime('%Y%m%d%H%M%S.0Z', time.gmtime(timestamp - SYNC_MARGIN))
+
+
+def foreman_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(timestamp - SYNC_MARGIN))
+
+
+class InventoryCache(object):
+    def __init__(self, path, full_ttl=86400):
+        """
+        Local snapshot of the inventories shared by every command
+        :param path: Path of the sqlite database
+        :param full_ttl: Age in seconds after which a snapshot is rebuilt from scratch, this is the only way
+                         to forget items removed from a source which only reports changes
+        """
+        self.full_ttl = full_ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS items '
+                             '(source TEXT, key TEXT, value TEXT, PRIMARY KEY (source, key))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS syncs '
+                             '(source TEXT PRIMARY KEY, full_sync REAL, last_sync REAL)')
+
+    def load(self, source, key, full, delta=None, ttl=0):
+        """
+        Refresh the snapshot of a source if needed and return its items, see refresh
+        :return: A dict key -> item
+        """
+        self.refresh(source, key, full, delta, ttl)
+        return self.items(source)
+
+    def refresh(self, source, key, full, delta=None, ttl=0):
+        """
+        Refresh the snapshot of a source if needed
+        :param source: Name of the snapshot. Ex: "foreman_hosts"
+        :param key: Function returning the unique key of an item
+        :param full: Function returning every item of the source
+        :param delta: Function returning the items changed since the given timestamp, without it the
+                      snapshot is fully rebuilt once expired
+        :param ttl: Age in seconds under which the snapshot is used without asking the source
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT full_sync, last_sync FROM syncs WHERE source = ?', (source,)).fetchone()
+        if row is None or now - row[0] > self.full_ttl or (delta is None and now - row[1] > ttl):
+            self._store(source, key, full(), now, replace=True)
+        elif now - row[1] > ttl:
+            self._store(source, key, delta(row[1]), now, replace=False)
+
+    def _store(self, source, key, items, now, replace):
+        with self._lock, self._db:
+            if replace:
+                self._db.execute('DELETE FROM items WHERE source = ?', (source,))
+                self._db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)', (source, now, now))
+            else:
+                self._db.execute('UPDATE syncs SET last_sync = ? WHERE source = ?', (now, source))
+            self._db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                                 ((source, str(key(item)), json.dumps(item)) for item in items))
+
+    def items(self, source):
+        with self._lock:
+            rows = self._db.execute('SELECT key, value FROM items WHERE source = ?', (source,)).fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def iter_pages(self, source, size=1000):
+        """ Yield the items of a source by pages ordered by key, the items removed meanwhile don't shift the pages """
+        last_key = ''
+        while True:
+            with self._lock:
+                rows = self._db.execute('SELECT key, value FROM items WHERE source = ? AND key > ? '
+                                        'ORDER BY key LIMIT ?', (source, last_key, size)).fetchall()
+            if not rows:
+                return
+            yield [json.loads(v) for _, v in rows]
+            last_key = rows[-1][0]
+
+    def save(self, source, key, items):
+        """ Replace the items of a source which is not synced from a backend """
+        self._store(source, key, items, time.time(), replace=True)
+
+    def add(self, source, key, items):
+        """ Add or replace some items of a source which is not synced from a backend """
+        self._store(source, key, items, time.time(), replace=False)
+
+    def remove(self, source, *keys):
+        """ Forget items deleted by the tools themselves """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM items WHERE source = ? AND key = ?', ((source, str(k)) for k in keys))
+
+
+def open_cache():
+    return InventoryCache(CACHE_PATH, CACHE_FULL_TTL) if CACHE_PATH else None
+
+
+def ds_source(ds):
+    """ Each DS gets its own snapshot, check_join and the cleaner may not use the same one """
+    return 'ds_computers:{}'.format(ds.computers_base_dn)
+
+
+def cached_ds_computers(cache, ds):
+    """
+    Load the DS computers from the cache, only the ones changed since the last sync are searched. The changes
+    don't include the deleted computers, so the dn of every computer is then listed to forget the missing ones
+    """
+    if cache is None:
+        return ds.computers
+    source = ds_source(ds)
+    searched = []
+
+    def delta(since):
+        searched.append(since)
+        return ds.iter_computers('(&(objectclass=computer)(whenChanged>={}))'.format(ldap_time(since)))
+    entries = cache.load(source, key=lambda e: e[0], full=ds.iter_computers, delta=delta, ttl=CACHE_DS_TTL)
+    if searched:
+        dns = set(dn for dn, _ in ds.iter_computers(attributes=['1.1']))
+        deleted = [dn for dn in entries if dn not in dns]
+        cache.remove(source, *deleted)
+        for dn in deleted:
+            del entries[dn]
+    ds.computers = [tuple(e) for e in entries.values()]
+    return ds.computers
+
+
+def cached_instance_ids(cache):
+    """ Return the ec2_instance_id facts fetched less than CACHE_FACTS_TTL seconds ago, by host """
+    if cache is None:
+        return {}
+    now = time.time()
+    instance_ids = {}
+    expired = []
+    for k, e in cache.items('ec2_instance_id').items():
+        # Older caches held the whole fact table without the time each host was fetched
+        if len(e) != 3 or now - e[2] > CACHE_FACTS_TTL:
+            expired.append(k)
+        else:
+            instance_ids[e[0]] = e[1]
+    cache.remove('ec2_instance_id', *expired)
+    return instance_ids
+
+
+def cache_instance_ids(cache, instance_ids):
+    """ Keep the facts fetched for some hosts, a host without the fact is kept too so it is not asked again """
+    now = time.time()
+    cache.add('ec2_instance_id', key=lambda e: e[0], items=[(host, facts, now) for host, facts in instance_ids.items()])
+
+
+def cached_ec2_instances(cache, domain_name, get_instances):
+    """ Load the name -> instance infos index of EC2 instances from the cache """
+    if cache is None:
+        return get_instances(domain_name)
+    entries = cache.load('ec2_instances:{}'.format(domain_name), key=lambda e: e[0],
+                         full=lambda: get_instances(domain_name).items(), ttl=CACHE_EC2_TTL)
+    return {name: infos for name, infos in entries.values()}
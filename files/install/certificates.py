@@ -0,0 +1,61 @@
+import logging
+import os
+import time
+from reconcile import compile_filters
+
+SIGNED_DIR = '/var/lib/puppet/ssl/ca/signed/'
+# Substrings of the certnames handled by clean-old-certificates
+CERT_PATTERNS = os.getenv('CERT_PATTERNS', 'ndev,nsta,nifd,npra,nifp-es5k,nhip,nifh,win,nprd,nqa').split(',')
+
+# Snapshots of the scanned directories, kept between the runs of a daemon when the cache is disabled
+_snapshots = {}
+
+
+class SignedCertificates(object):
+    def __init__(self, signed_dir=SIGNED_DIR, patterns=None, cache=None):
+        """
+        Inventory of the certificates signed by the puppet CA, read from its directory
+        :param signed_dir: Directory of the signed certificates, one <certname>.pem file each
+        :param patterns: Substrings of the certnames to keep, CERT_PATTERNS by default
+        :param cache: The InventoryCache keeping the snapshot of the directory between runs
+        """
+        self.signed_dir = signed_dir
+        self.patterns = sorted(patterns or CERT_PATTERNS)
+        self._match = compile_filters(self.patterns)
+        self._cache = cache
+
+    def _load(self):
+        if self._cache is None:
+            return _snapshots.get(self.signed_dir)
+        return self._cache.items('signed_certificates').get(self.signed_dir)
+
+    def _save(self, snapshot):
+        if self._cache is None:
+            _snapshots[self.signed_dir] = snapshot
+        else:
+            self._cache.save('signed_certificates', key=lambda s: s['path'], items=[snapshot])
+
+    def certnames(self):
+        """
+        Return the certnames matching the patterns. The directory is only listed again when its mtime changed,
+        and then only the files added since the last scan are matched.
+        """
+        mtime = os.stat(self.signed_dir).st_mtime
+        snapshot = self._load()
+        if snapshot is None or snapshot['patterns'] != self.patterns:
+            snapshot = {'files': {}}
+        elif snapshot['mtime'] == mtime:
+            return [name[:-len('.pem')] for name, matched in snapshot['files'].items() if matched]
+
+        known = snapshot['files']
+        names = set(name for name in os.listdir(self.signed_dir) if name.endswith('.pem'))
+        added = names.difference(known)
+        files = dict((name, known[name]) for name in names.intersection(known))
+        files.update((name, self._match(name)) for name in added)
+        logging.info("{} signed certificates added and {} removed since the last scan".format(
+            len(added), len(known) - (len(names) - len(added))))
+
+        # A file added in the same tick as the mtime read would not change the mtime, then list again next time
+        self._save({'path': self.signed_dir, 'mtime': mtime if time.time() - mtime > 2 else None,
+                    'patterns': self.patterns, 'files': files})
+        return [name[:-len('.pem')] for name, matched in files.items() if matched]
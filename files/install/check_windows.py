@@ -1,14 +1,24 @@
-from awsutils import AwsDs
+from awsutils import AwsDs, connect_ldap
 import ldap
 import logging
 import sys
 from awsutils import get_instances_from_ec2
+from cache import open_cache, cached_ds_computers, cached_ec2_instances
+from reconcile import reconcile, compile_filters
+from ratelimit import TokenBucket
+import clients
+import metrics
+import profiling
 import click
 import yaml
 
 @click.group()
-def main():
-    pass
+@click.option("--profile", default=None, help="Path of a file receiving the cProfile stats of the run")
+@click.option("--trace-file", default=None, help="Path of a file receiving the Chrome trace of the backend calls")
+@click.pass_context
+def main(ctx, profile, trace_file):
+    profiling.start(profile, trace_file)
+    ctx.call_on_close(profiling.stop)
 
 
 @main.command()
@@ -27,64 +37,66 @@ def check_join(config_file):
     bind_password = config['domain_password']
     search_filters = config['search_filters']
     auto_heal = config['auto_heal']
+    auto_heal_rate = config.get('auto_heal_rate', 5)
+    regions = config.get('regions')
+    assume_roles = config.get('assume_roles')
 
     # Connect to the DS
     try:
-        ds = AwsDs(domain_name, computers_base_dn, bind_user_dn, bind_password)
+        con = clients.get('ldap:{}:{}'.format(domain_name, bind_user_dn),
+                          lambda: connect_ldap(domain_name, bind_user_dn, bind_password))
+        ds = AwsDs(domain_name, computers_base_dn, bind_user_dn, bind_password, connection=con)
     except ldap.INVALID_CREDENTIALS:
-        raise "Your username or password is incorrect."
+        raise click.ClickException("Your username or password is incorrect.")
+
+    run = metrics.Run('check_join')
 
     # Get all ds computer
     ds_computers = {}
-    for c_dn, attr in ds.computers:
+    cache = open_cache()
+    computers = ds.iter_computers() if cache is None else cached_ds_computers(cache, ds)
+    for c_dn, attr in run.timed_iter('ldap_scan', computers):
         ds_computers[attr['cn'][0].lower()] = attr.get('dNSHostName', None)
-    # Extract only dns name
-    ds_computers_names = [dns_names[0] for cn, dns_names in ds_computers.iteritems() for p in search_filters if dns_names and p in dns_names[0]]
+    run.processed(len(ds_computers))
 
     # Get all running ec2 instances
-    ec2_instances = get_instances_from_ec2(domain_name)
-    # Extract only names
-    ec2_instances_names = [dns_name for dns_name, instance_infos in ec2_instances.iteritems() for pattern in search_filters if pattern in dns_name ]
-    ec2_instances_cn = [instance_infos['cn'] for dns_name, instance_infos in ec2_instances.iteritems() for pattern in
-                           search_filters if pattern in dns_name]
-    unjoined_machines = set(ec2_instances_names) - set(ds_computers_names)
-    unjoined_machines = list(unjoined_machines)
-    joined_machines = set(ec2_instances_names) & set(ds_computers_names)
-
-    need_repair = [cn for cn, dns_names in ds_computers.iteritems() for p in search_filters if not dns_names and p in cn and cn in ec2_instances_cn]
+    with run.phase('ec2_inventory'):
+        ec2_instances = cached_ec2_instances(cache, domain_name,
+                                             lambda d: get_instances_from_ec2(d, regions, assume_roles))
 
-    # Delete from unjoined list machines which need repair
-    for m in need_repair:
-        for i, v in enumerate(unjoined_machines):
-            if m in v:
-                del unjoined_machines[i]
-
-    # Delete from repair list machine which is stopped in ec2
-    for ec2_instance in ec2_instances_names:
-        if ec2_instances[ec2_instance]['status'] != 'running':
-            for i, v in enumerate(need_repair):
-                if v in ec2_instance:
-                    del need_repair[i]
+    with run.phase('reconciliation'):
+        report = reconcile(ds_computers, ec2_instances, compile_filters(search_filters))
+    unjoined_machines = report.unjoined
+    joined_machines = report.joined
+    need_repair = report.need_repair
 
     if unjoined_machines:
         logging.info("--------------------------------")
         logging.info("Unjoined machines:")
         for m in unjoined_machines:
             logging.info('{} ec2status :{}'.format(m, ec2_instances[m]['status']))
-            if auto_heal:
-                logging.info("autoheal is enabled, try to re-create computer in DS")
-                try:
-                    ds.add_computer('CN={},{}'.format(ec2_instances[m]['cn'], computers_base_dn))
-                    logging.info("Autoheal succeeded")
-                    need_repair.append(m)
-                except:
-                    logging.error('Autoheal failed')
+        if auto_heal:
+            logging.info("autoheal is enabled, try to re-create computers in DS")
+            dns = {'CN={},{}'.format(ec2_instances[m]['cn'], computers_base_dn): m for m in unjoined_machines}
+            with run.phase('auto_heal'):
+                results = ds.add_computers(dns, limiter=TokenBucket(auto_heal_rate) if auto_heal_rate > 0 else None)
+            for dn, error in sorted(results.items()):
+                if error:
+                    logging.error('Autoheal failed for {} : {}'.format(dns[dn], error))
+                else:
+                    logging.info("Autoheal succeeded for {}".format(dns[dn]))
+                    need_repair.append(dns[dn])
     else:
         logging.info('All Windows machine are joined to the domain')
     logging.debug("--------------------------------")
     logging.debug("Joined machines:")
     for m in joined_machines:
         logging.debug(m)
+    if report.stopped:
+        logging.debug("--------------------------------")
+        logging.debug("Stopped machines which will need to repair the AD secureChannel:")
+        for m in report.stopped:
+            logging.debug(m)
     if need_repair:
         logging.info("--------------------------------")
         logging.info("Machine which need to repair the AD secureChannel:")
@@ -94,6 +106,21 @@ def check_join(config_file):
         for m in need_repair:
             logging.info(m)
 
+    run.finish({
+        'windows_joined': {
+            'description': 'count of windows machines joined to the domain',
+            'value': len(joined_machines)
+        },
+        'windows_unjoined': {
+            'description': 'count of windows machines running in EC2 which are not in the ds',
+            'value': len(unjoined_machines)
+        },
+        'windows_need_repair': {
+            'description': 'count of windows machines which need to repair their AD secureChannel',
+            'value': len(need_repair)
+        },
+    })
+
 if __name__ == "__main__":
     logging.getLogger('botocore').setLevel(logging.WARN)
     logging.getLogger('boto3').setLevel(logging.WARN)
@@ -0,0 +1,25 @@
+import threading
+
+# Clients kept between runs, only when running as a daemon
+_clients = None
+_lock = threading.Lock()
+
+
+def keep_warm():
+    """ From now on, clients are created once and shared by every run """
+    global _clients
+    _clients = {}
+
+
+def get(name, factory):
+    """
+    :param name: Name of the client. Ex: "foreman"
+    :param factory: Function creating the client
+    :return: The shared client when keep_warm was called, else a new one
+    """
+    if _clients is None:
+        return factory()
+    with _lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
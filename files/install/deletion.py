@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Backend(object):
+    def __init__(self, name, concurrency=1, retries=2, backoff=1.0, fatal=(), retryable=None):
+        """
+        :param name: Name of the backend, used in logs. Ex: "foreman"
+        :param concurrency: Maximum number of calls running at the same time against this backend
+        :param retries: Number of time a failed call is retried
+        :param backoff: Delay in seconds before the first retry, doubled after each retry
+        :param fatal: Exceptions which are never retried
+        :param retryable: Function returning whether an exception is retried, every exception is by default
+        """
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.fatal = tuple(fatal)
+        self.retryable = retryable
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            with self._slots:
+                try:
+                    return func(*args, **kwargs)
+                except self.fatal:
+                    raise
+                except Exception as e:
+                    if attempt >= self.retries or (self.retryable and not self.retryable(e)):
+                        raise
+                    error = e
+            delay = self.backoff * 2 ** attempt
+            attempt += 1
+            logging.warning("{} call failed ({}), retry {}/{} in {}s".format(
+                self.name, error, attempt, self.retries, delay))
+            time.sleep(delay)
+
+
+class DeletionExecutor(object):
+    def __init__(self, steps, workers=4):
+        """
+        :param steps: List of (backend, callable) run in order for each host, a step is
+                      only run when the previous one succeeded
+        :param workers: Number of hosts deleted at the same time
+        """
+        self._steps = steps
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+
+    def submit(self, host):
+        self._futures.append((host, self._pool.submit(self._delete, host)))
+
+    def _delete(self, host):
+        for backend, step in self._steps:
+            backend.call(step, host)
+
+    def results(self):
+        """ Wait for every submitted deletion and yield (host, exception or None) in submission order """
+        try:
+            for host, future in self._futures:
+                yield host, future.exception()
+        finally:
+            self._futures = []
+            self._pool.shutdown()
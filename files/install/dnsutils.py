@@ -0,0 +1,53 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import track
+
+# Answer of a lookup which timed out or failed for another reason than a missing record, the host may still exist
+UNKNOWN = object()
+# Errors meaning that the hostname has no record
+NOT_FOUND_ERRORS = (socket.gaierror, socket.herror)
+
+
+def _lookup(hostname, resolve, timeout, slots):
+    """
+    Run resolve in a daemon thread so that a hanging lookup is abandoned after timeout seconds. The thread keeps its
+    slot until resolve returns, so the abandoned lookups still count in the concurrency.
+    """
+    answer = {'ip': UNKNOWN}
+
+    def target():
+        try:
+            with track('dns', 'resolve'):
+                answer['ip'] = resolve(hostname)
+        except NOT_FOUND_ERRORS:
+            answer['ip'] = None
+        except Exception:
+            pass
+        finally:
+            slots.release()
+
+    slots.acquire()
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    return answer['ip']
+
+
+def resolve_hostnames(hostnames, resolve=socket.gethostbyname, timeout=2.0, concurrency=32):
+    """
+    Resolve hostnames concurrently
+    :param hostnames: Hostnames to resolve
+    :param resolve: Function returning the ip of a hostname, or raising socket.gaierror if it has no record
+    :param timeout: Maximum time in seconds spent on a single lookup
+    :param concurrency: Maximum number of lookups running at the same time, including the abandoned ones
+    :return: A dict hostname -> ip, None when the hostname has no record or UNKNOWN when the lookup timed out or failed
+    """
+    hostnames = list(set(hostnames))
+    if not hostnames:
+        return {}
+    slots = threading.BoundedSemaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        ips = pool.map(lambda h: _lookup(h, resolve, timeout, slots), hostnames)
+        return dict(zip(hostnames, ips))
@@ -3,8 +3,13 @@
 # Create Certificate
 puppet agent --noop --server=$FOREMANPROXY_HOST
 
+# Run every job from a single long lived process instead of cron
+if [ "$FOREMAN_CLEANER_MODE" = "serve" ]; then
+    exec /usr/bin/python -W ignore /install/host-cleaner.py serve -c /install/config.yaml
+fi
+
 # Get env variable for cronjob
-env | grep -E 'AWS|FOREMAN|DS|LDAP|COMPUTER_DN' | sed 's/^\(.*\)$/export \1/g' > /root/envs.sh
+env | grep -E 'AWS|FOREMAN|DS|LDAP|COMPUTER_DN|DELETE|PUPPET|DNS|CERT|CACHE|METRICS|PROMETHEUS|SHARD|EC2|STS|RATE_LIMIT|MAX_CONCURRENCY' | sed 's/^\(.*\)$/export \1/g' > /root/envs.sh
 chmod +x /root/envs.sh
 
 # Add cron for clean
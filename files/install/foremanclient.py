@@ -0,0 +1,71 @@
+import requests
+import profiling
+
+
+class ForemanError(Exception):
+    def __init__(self, status_code, message):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class ForemanClient(object):
+    def __init__(self, url, auth=None, verify=False, api_version=2, timeout=60, timeout_delete=600, pool_size=10):
+        """
+        Client of the few foreman API endpoints used by the tools, it needs no API definition so nothing is
+        downloaded or generated before the first request
+        :param url: Url of foreman. Ex: "https://confmanager.corp.com"
+        :param auth: Tuple with the user and the password
+        :param timeout: Timeout in seconds of the requests
+        :param timeout_delete: Timeout in seconds of the deletions, foreman may take long to destroy a host
+        :param pool_size: Number of connections kept open to foreman
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.timeout_delete = timeout_delete
+        self.session = requests.Session()
+        self.session.verify = verify
+        if auth is not None:
+            self.session.auth = auth
+
+        self.session.headers.update(
+        {
+            'Accept': 'application/json; version={}'.format(api_version),
+            'Accept-Encoding': 'gzip, deflate',
+            'Content-type': 'application/json',
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def _result(res):
+        profiling.annotate(status=res.status_code, bytes=len(res.content))
+        # Like python-foreman, a missing resource is an empty result
+        if res.status_code == 404:
+            return []
+        if res.status_code < 200 or res.status_code >= 300:
+            raise ForemanError(res.status_code, 'Something went wrong: {} {}'.format(res.status_code, res.text))
+        try:
+            return res.json()
+        except ValueError:
+            return res.text
+
+    def do_get(self, url, kwargs):
+        """
+        :param url: Url of the resource, relative to the foreman url. Ex: "/api/fact_values"
+        :param kwargs: Parameters of the query
+        """
+        return self._result(self.session.get(self.url + url, params=kwargs, timeout=self.timeout))
+
+    def index_hosts(self, fields=None, **kwargs):
+        """
+        :param fields: Keys kept in each host, the others are dropped as soon as the page is parsed
+        :param kwargs: Parameters of the query. Ex: per_page, page, search
+        """
+        page = self.do_get('/api/hosts', kwargs)
+        if fields and isinstance(page, dict):
+            page['results'] = [{field: host.get(field) for field in fields} for host in page['results']]
+        return page
+
+    def destroy_hosts(self, id):
+        return self._result(self.session.delete('{}/api/hosts/{}'.format(self.url, id), timeout=self.timeout_delete))
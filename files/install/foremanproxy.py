@@ -1,12 +1,75 @@
+import codecs
+import json
 import requests
 import socket
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from foremanclient import ForemanError
+from metrics import track
+import profiling
+
+
+def _iter_json_object(chunks):
+    """ Yield the (key, value) of a JSON object while its chunks are downloaded, without holding the whole document """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, key, state = u'', 0, None, 'start'
+    for chunk in chunks:
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+            if state == 'start':
+                if buf[pos] != '{':
+                    raise ValueError('A JSON object was expected')
+                pos, state = pos + 1, 'key'
+            elif state in ('key', 'value'):
+                if state == 'key' and buf[pos] == '}':
+                    return
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # The item is not complete yet
+                    break
+                if end == len(buf):
+                    # Wait for the end of the item to be sure it is complete
+                    break
+                pos = end
+                if state == 'key':
+                    key, state = item, 'colon'
+                else:
+                    state = 'comma'
+                    yield key, item
+            elif state == 'colon':
+                if buf[pos] != ':':
+                    raise ValueError('":" was expected at {}'.format(pos))
+                pos, state = pos + 1, 'value'
+            else:
+                if buf[pos] == '}':
+                    return
+                if buf[pos] != ',':
+                    raise ValueError('"," was expected at {}'.format(pos))
+                pos, state = pos + 1, 'key'
+    raise ValueError('The JSON object is truncated')
 
 
 class ForemanProxy(object):
-    def __init__(self, url, auth=None, verify=False):
+    def __init__(self, url, auth=None, verify=False, cert_backend='puppet', puppet_bin='/usr/bin/puppet', pool_size=10):
+        """
+        :param url: Url of the foreman proxy. Ex: "https://puppet.example.com:8443"
+        :param cert_backend: How certificates are deleted, "puppet" runs puppet cert clean locally,
+                             "http" calls the foreman proxy puppet CA api
+        :param puppet_bin: Path of the puppet executable
+        :param pool_size: Number of connections kept open to the foreman proxy
+        """
         self.session = requests.Session()
         self.url = url
+        self.cert_backend = cert_backend
+        self.puppet_bin = puppet_bin
+        self.pool_size = pool_size
         self.session.verify = verify
         if auth is not None:
             self.session.auth = auth
@@ -16,24 +79,102 @@ class ForemanProxy(object):
             'Accept': 'application/json',
             'Content-type': 'application/json',
         })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
         fqdn = socket.getfqdn()
         self.session.cert = ('/var/lib/puppet/ssl/certs/{}.pem'.format(fqdn), '/var/lib/puppet/ssl/private_keys/{}.pem'.format(fqdn))
 
-    def delete_certificate(self, host):
-        res = subprocess.Popen('/usr/bin/puppet cert clean {}'.format(host)
-                               ,stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        # Wait for the process end and print error in case of failure
-        if res.wait() != 0:
+    def _cert_clean(self, hosts):
+        res = subprocess.Popen([self.puppet_bin, 'cert', 'clean'] + list(hosts),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Wait for the process end and raise the error in case of failure
+        with track('puppet', 'cert_clean'):
             output, error = res.communicate()
-            Exception(error)
-        else:
-            print('Puppet - certificate {} deleted'.format(host))
+            profiling.annotate(certificates=len(hosts))
+            if res.returncode != 0:
+                raise Exception(error)
+
+    def delete_certificate(self, host):
+        if self.cert_backend == 'http':
+            return self.revoke_certificate(host)
+        try:
+            self._cert_clean([host])
+        except Exception as e:
+            # A certificate cleaned by a previous attempt or a failed batch counts as deleted
+            if 'Could not find' not in str(e):
+                raise
+        print('Puppet - certificate {} deleted'.format(host))
+
+    def revoke_certificate(self, host):
+        uri = "/puppet/ca/{}".format(host)
+        with track('foreman_proxy', 'delete_certificate'):
+            r = self.session.delete(self.url + uri)
+            profiling.annotate(status=r.status_code, bytes=len(r.content))
+            # A certificate revoked by a previous attempt counts as deleted
+            if r.status_code != 404 and (r.status_code < 200 or r.status_code >= 300):
+                raise ForemanError(r.status_code, 'Something went wrong: %s' % r.text)
+        print('Puppet - certificate {} deleted'.format(host))
+
+    def delete_certificates(self, hosts, batch_size=50):
+        """
+        Delete many certificates, with one puppet run per batch or with concurrent calls to the foreman proxy
+        :param hosts: Certnames to delete
+        :param batch_size: Number of certnames given to a single puppet cert clean
+        :return: A dict certname -> None if the certificate was deleted, else the exception raised
+        """
+        hosts = list(hosts)
+        if self.cert_backend == 'http':
+            with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+                futures = [(host, pool.submit(self.revoke_certificate, host)) for host in hosts]
+            return {host: future.exception() for host, future in futures}
+
+        results = {}
+        for i in range(0, len(hosts), batch_size):
+            batch = hosts[i:i + batch_size]
+            try:
+                self._cert_clean(batch)
+            except Exception:
+                # puppet stops at the first failure, clean the batch one by one to know which certificate failed
+                for host in batch:
+                    results[host] = self._clean_after_failed_batch(host)
+                continue
+            for host in batch:
+                print('Puppet - certificate {} deleted'.format(host))
+                results[host] = None
+        return results
+
+    def _clean_after_failed_batch(self, host):
+        # The certificates cleaned by the failed batch before it stopped are not found any more, they count as deleted
+        try:
+            self.delete_certificate(host)
+        except Exception as e:
+            return e
+        return None
+
+    def iter_certificates(self, state=None):
+        """
+        Yield the names of the certificates of the puppet CA, the response is parsed while it is downloaded
+        :param state: Only yield the certificates in this state. Ex: "valid"
+        """
+        uri = "/puppet/ca"
+        with track('foreman_proxy', 'get_certificates'):
+            r = self.session.get(self.url + uri, stream=True)
+            # The body is only read once the call is over, its size is the announced one
+            profiling.annotate(status=r.status_code, bytes=int(r.headers.get('Content-Length', 0)))
+            if r.status_code < 200 or r.status_code >= 300:
+                raise ForemanError(r.status_code, 'Something went wrong: %s' % r.text)
+        for name, infos in _iter_json_object(r.iter_content(64 * 1024)):
+            if state is None or infos.get('state') == state:
+                yield name
 
     def get_certificates(self):
         uri = "/puppet/ca"
-        r = self.session.get(self.url + uri)
+        with track('foreman_proxy', 'get_certificates'):
+            r = self.session.get(self.url + uri)
+            profiling.annotate(status=r.status_code, bytes=len(r.content))
         if r.status_code < 200 or r.status_code >= 300:
             print('Something went wrong: %s' % r.text)
         else:
-            return r.json()
\ No newline at end of file
+            return r.json()
@@ -1,17 +1,32 @@
 import click
+import copy
 import datetime
+import math
 import os
 import json
-from foreman.client import Foreman
+from collections import deque
+from itertools import islice
+from foremanclient import ForemanClient
 from foremanproxy import ForemanProxy
-from awsutils import get_ec2_instance_state, AwsDs
+from awsutils import AwsDs, connect_ldap, Ec2StateResolver, NotFound, TooManyResult
+from deletion import Backend, DeletionExecutor
+from prefixes import PrefixSet
+from dnsutils import resolve_hostnames, UNKNOWN
+from scheduler import Scheduler
+import clients
+import ratelimit
+import sharding
+import check_windows
+from certificates import SignedCertificates, CERT_PATTERNS
+from reconcile import compile_filters
+from cache import open_cache, cached_ds_computers, cached_instance_ids, cache_instance_ids, ds_source, foreman_time
 import ldap
 import re
-import socket
-from subprocess import check_output
 import logging
 import sys
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import profiling
 
 # Retrieve config from ENV
 FOREMAN_URL = os.environ.get('FOREMAN_URL')
@@ -24,50 +39,233 @@ LDAP_HOST = os.environ.get('LDAP_HOST')
 COMPUTERS_BASE_DN = os.environ.get('COMPUTER_DN')
 BIND_USER_DN = os.environ.get('DS_USER')
 BIND_PASSWORD = os.environ.get('DS_PASSWORD')
-PROMETHEUS_ENDPOINT = os.environ.get('PROMETHEUS_ENDPOINT')
+METRICS_PORT = os.environ.get('METRICS_PORT')
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', '8'))
+DELETE_RETRIES = int(os.getenv('DELETE_RETRIES', '2'))
+FOREMAN_CONCURRENCY = int(os.getenv('FOREMAN_CONCURRENCY', '4'))
+PUPPET_CONCURRENCY = int(os.getenv('PUPPET_CONCURRENCY', '2'))
+DS_CONCURRENCY = int(os.getenv('DS_CONCURRENCY', '1'))
+FOREMAN_PAGE_WORKERS = int(os.getenv('FOREMAN_PAGE_WORKERS', '8'))
+FOREMAN_READ_RETRIES = int(os.getenv('FOREMAN_READ_RETRIES', '3'))
+CERT_BACKEND = os.getenv('CERT_BACKEND', 'puppet')
+PUPPET_BIN = os.getenv('PUPPET_BIN', '/usr/bin/puppet')
+CLEAN_OLD_HOST_SCHEDULE = os.getenv('CLEAN_OLD_HOST_SCHEDULE', '0 * * * *')
+CLEAN_OLD_CERTIFICATES_SCHEDULE = os.getenv('CLEAN_OLD_CERTIFICATES_SCHEDULE', '30 11 * * *')
+CLEAN_DS_SCHEDULE = os.getenv('CLEAN_DS_SCHEDULE', '30 6 * * *')
+CHECK_JOIN_SCHEDULE = os.getenv('CHECK_JOIN_SCHEDULE', '30 * * * *')
+DNS_TIMEOUT = float(os.getenv('DNS_TIMEOUT', '2'))
+DNS_CONCURRENCY = int(os.getenv('DNS_CONCURRENCY', '32'))
+
+# Only the host fields used by the commands are kept in memory and in the cache
+HOST_FIELDS = ['id', 'name', 'certname', 'ip', 'mac', 'last_compile', 'last_report', 'created_at']
+
+
+def connect_foreman():
+    # Size the connection pool so that concurrent page fetches and deletions reuse their connections
+    return clients.get('foreman', lambda: ForemanClient(FOREMAN_URL, (FOREMAN_USER, FOREMAN_PASSWORD),
+                                                        pool_size=max(FOREMAN_PAGE_WORKERS, DELETE_WORKERS)))
+
+
+def connect_foreman_proxy():
+    return clients.get('foreman_proxy', lambda: ForemanProxy(
+        FOREMAN_PROXY_URL, cert_backend=CERT_BACKEND, puppet_bin=PUPPET_BIN, pool_size=max(PUPPET_CONCURRENCY, 10)))
+
+
+def connect_ds():
+    try:
+        con = clients.get('ldap:{}:{}'.format(LDAP_HOST, BIND_USER_DN),
+                          lambda: connect_ldap(LDAP_HOST, BIND_USER_DN, BIND_PASSWORD))
+    except ldap.INVALID_CREDENTIALS:
+        raise click.ClickException("Your username or password is incorrect.")
+    # Only the connection is shared, each run loads its own computers so that overlapping runs don't mix them
+    return AwsDs(LDAP_HOST, COMPUTERS_BASE_DN, BIND_USER_DN, BIND_PASSWORD, connection=con)
 
 
-def foreman_wrapper(foreman_call, call_args=None):
-    last_len = 1
-    args = call_args or {}
+# A throttled or failed page is fetched again instead of failing the whole run
+foreman_reads = Backend('foreman', FOREMAN_PAGE_WORKERS, FOREMAN_READ_RETRIES, retryable=ratelimit.is_retryable)
+
 
-    if "kwargs" in call_args:
-        args['kwargs']['page'] = 1
+def foreman_page(foreman_call, call_args, page):
+    args = copy.deepcopy(call_args)
+    if "kwargs" in args:
+        args['kwargs']['page'] = page
     else:
-        args['page'] = 1
+        args['page'] = page
 
-    result = foreman_call(**args)['results']
-    while last_len > 0:
-        if "kwargs" in call_args:
-            args['kwargs']['page'] += 1
-        else:
-            args['page'] += 1
-        tmp_result = foreman_call(**args)['results']
-        last_len = len(tmp_result)
+    def get():
+        with metrics.track('foreman', getattr(foreman_call, '__name__', 'get')):
+            return foreman_call(**args)
+    return foreman_reads.call(get)
+
+
+def iter_foreman_pages(foreman_call, call_args=None, totals=None):
+    """
+    Yield the results of each page in order, the next pages are fetched while the current one is consumed
+    :param totals: A dict receiving the total and subtotal (the count matching the search) of the first page
+    """
+    args = call_args or {}
+    first_page = foreman_page(foreman_call, args, 1)
+    if totals is not None:
+        totals['total'] = first_page.get('total', 0)
+        totals['subtotal'] = first_page.get('subtotal', totals['total'])
+
+    count = first_page.get('subtotal', first_page.get('total'))
+    per_page = int(first_page.get('per_page') or 0)
+    if count is not None and per_page:
+        # The page count is known from the first page, keep a bounded window of pages in flight
+        pages = iter(range(2, int(math.ceil(float(count) / per_page)) + 1))
+        with ThreadPoolExecutor(max_workers=FOREMAN_PAGE_WORKERS) as pool:
+            in_flight = deque(pool.submit(foreman_page, foreman_call, args, page)
+                              for page in islice(pages, FOREMAN_PAGE_WORKERS))
+            yield first_page['results']
+            while in_flight:
+                tmp_result = in_flight.popleft().result()['results']
+                for page in islice(pages, 1):
+                    in_flight.append(pool.submit(foreman_page, foreman_call, args, page))
+                yield tmp_result
+        return
+
+    # Without pagination info, fetch pages until an empty one is returned
+    tmp_result = first_page['results']
+    page = 1
+    yield tmp_result
+    while len(tmp_result) > 0:
+        page += 1
+        tmp_result = foreman_page(foreman_call, args, page)['results']
+        if tmp_result:
+            yield tmp_result
+
+
+def iter_foreman_pages_by_id(foreman_call, call_args=None, totals=None):
+    """
+    Yield the results of each page ordered by id, each page is searched after the last id of the previous one so that
+    the hosts deleted meanwhile don't shift the next pages. The next page is fetched while the current one is consumed
+    :param totals: A dict receiving the total and subtotal (the count matching the search) of the first page
+    """
+    args = call_args or {}
+    search = args.get('search')
+
+    def page_after(last_id):
+        keyset = 'id > {}'.format(last_id)
+        return foreman_page(foreman_call, dict(args, order='id ASC',
+                                               search='({}) and {}'.format(search, keyset) if search else keyset), 1)
+
+    page = page_after(0)
+    if totals is not None:
+        totals['total'] = page.get('total', 0)
+        totals['subtotal'] = page.get('subtotal', totals['total'])
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while page['results']:
+            tmp_result = page['results']
+            per_page = int(page.get('per_page') or 0)
+            if per_page and len(tmp_result) < per_page:
+                yield tmp_result
+                return
+            next_page = pool.submit(page_after, max(host['id'] for host in tmp_result))
+            yield tmp_result
+            page = next_page.result()
 
-        if isinstance(tmp_result, dict):
+
+def foreman_wrapper(foreman_call, call_args=None):
+    result = None
+    for tmp_result in iter_foreman_pages(foreman_call, call_args):
+        if result is None:
+            result = tmp_result
+        elif isinstance(tmp_result, dict):
             result.update(tmp_result)
         else:
             result += tmp_result
     return result
 
 
-def build_from_cn(cn):
-    return "{}.{}".format(cn.lower(), LDAP_HOST.lower())
+def iter_foreman_hosts(f, cache=None, search=None, totals=None, by_id=False, matches=None):
+    """
+    Yield pages of foreman hosts, from the local cache when it is enabled
+    :param search: Foreman search of the hosts, matches replaces it when the cache is enabled
+    :param totals: A dict receiving the total and subtotal of the search, filled as the cached pages are read
+    :param by_id: Page by id, for callers deleting the hosts while they are listed
+    :param matches: Function selecting the cached hosts returned by the search, every host by default
+    """
+    if cache is None:
+        call_args = {"per_page": 1000, "fields": HOST_FIELDS}
+        if search:
+            call_args["search"] = search
+        pages = iter_foreman_pages_by_id if by_id else iter_foreman_pages
+        for result in pages(f.index_hosts, call_args=call_args, totals=totals):
+            yield result
+        return
+
+    # Every command deletes what is missing from or stale in this list, so the changes are fetched on every run
+    cache.refresh(
+        'foreman_hosts', key=lambda h: h['id'],
+        full=lambda: foreman_wrapper(f.index_hosts, call_args={"per_page": 1000, "fields": HOST_FIELDS}),
+        delta=lambda since: foreman_wrapper(f.index_hosts, call_args={
+            "per_page": 1000, "fields": HOST_FIELDS, "search": 'updated_at > "{}"'.format(foreman_time(since))}),
+    )
+    if totals is not None:
+        totals.update(total=0, subtotal=0)
+    # The snapshot is read by pages of keys, the hosts deleted meanwhile don't shift them
+    for hosts in cache.iter_pages('foreman_hosts', 1000):
+        result = [host for host in hosts if matches(host)] if matches else hosts
+        if totals is not None:
+            totals['total'] += len(hosts)
+            totals['subtotal'] += len(result)
+        if result:
+            yield result
+
+
+def fetch_instance_ids(f, hostnames, instance_ids, chunk_size=100):
+    """
+    Fetch the ec2_instance_id fact of the hosts not fetched yet, with concurrent searches of chunk_size hosts
+    :param instance_ids: The {host: {'ec2_instance_id': id}} of the run, a host without the fact gets {}
+    :return: The {host: {'ec2_instance_id': id}} fetched by this call
+    """
+    missing = sorted(set(hostnames) - set(instance_ids))
+    if not missing:
+        return {}
+
+    def search(chunk):
+        return foreman_wrapper(f.do_get, call_args={'url': '/api/fact_values', 'kwargs': {
+            'per_page': 1000, 'search': 'name = ec2_instance_id and host ^ ({})'.format(','.join(chunk))}})
 
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=FOREMAN_PAGE_WORKERS) as pool:
+        for facts in pool.map(search, chunks):
+            fetched.update(facts or {})
+    for host in missing:
+        fetched.setdefault(host, {})
+    instance_ids.update(fetched)
+    return fetched
 
-def push_metrics(metrics_dict):
-    registry = CollectorRegistry()
-    for name, config in metrics_dict.items():
-        g = Gauge("foreman_cleaner_{}".format(name), config['description'], registry=registry, labelnames=["instance"])
-        g.labels(instance='k8s-foreman-cleaner').set_to_current_time()
-        g.labels(instance='k8s-foreman-cleaner').set(config["value"])
-        push_to_gateway(PROMETHEUS_ENDPOINT, job="foreman_cleaner", registry=registry)
+
+def destroy_foreman_host(f, cache, host):
+    with metrics.track('foreman', 'destroy_hosts'):
+        f.destroy_hosts(id=host["id"])
+    if cache is not None:
+        cache.remove('foreman_hosts', host["id"])
+
+
+def delete_ds_computer(ds, cache, hostname):
+    dn = ds.delete_computer(hostname)
+    if cache is not None:
+        cache.remove(ds_source(ds), dn)
+
+
+def build_from_cn(cn):
+    return "{}.{}".format(cn.lower(), LDAP_HOST.lower())
 
 
 @click.group()
-def main():
-    pass
+@click.option("--profile", default=None, help="Path of a file receiving the cProfile stats of the run")
+@click.option("--trace-file", default=None, help="Path of a file receiving the Chrome trace of the backend calls")
+@click.pass_context
+def main(ctx, profile, trace_file):
+    if (profile or trace_file) and ctx.invoked_subcommand == 'serve':
+        # The jobs of the daemon overlap and a stopped daemon never writes the files, profile a single run instead
+        raise click.UsageError("--profile and --trace-file can't be used with serve, profile a single command instead")
+    profiling.start(profile, trace_file)
+    ctx.call_on_close(profiling.stop)
 
 
 @main.command()
@@ -76,42 +274,59 @@ def main():
 def clean_old_certificates(json_file, check_on_fs):
     """ This method that will clear all puppet cert for instances that do not still exist """
     logging.info("########## Start Cleaning ###########")
+    shard = sharding.current_shard()
+    run = metrics.Run('clean_old_certificates', shard.grouping_key())
+    outcomes = {
+        'certificates_deleted': {
+            'description': 'count of puppet certificates deleted because their host is not in foreman',
+            'value': 0
+        },
+        'certificates_delete_failed': {
+            'description': 'count of puppet certificates unsuccessfully deleted',
+            'value': 0
+        },
+    }
     # connect to Foreman and ForemanProxy
-    f = Foreman(FOREMAN_URL, (FOREMAN_USER, FOREMAN_PASSWORD), api_version=2)
-    fp = ForemanProxy(FOREMAN_PROXY_URL)
-
-    host_pattern = ['ndev', 'nsta', 'nifd', 'npra',
-                    'nifp-es5k', 'nhip', 'nifh', 'win', 'nprd', 'nqa']
-    if not json_file and check_on_fs:
-        jcerts = check_output(
-            ["ls", "-f", "/var/lib/puppet/ssl/ca/signed/"]).split()
-    elif not json_file and not check_on_fs:
-        fp_certs = fp.get_certificates()
-        jcerts = [c for c in fp_certs if fp_certs[c].get('state') == 'valid']
-    else:
-        try:
-            with open(json_file) as data_file:
-                jcerts = json.load(data_file)
-        except Exception as e:
-            print("Cant't decode json file: {}".format(e))
-            sys.exit(0)
-    certs = [cert.replace(".pem", "") for cert in jcerts if any(
-        pattern in cert for pattern in host_pattern)]
+    f = connect_foreman()
+    fp = connect_foreman_proxy()
+
+    cache = open_cache()
+    match = compile_filters(CERT_PATTERNS)
+    with run.phase('certificates'):
+        if not json_file and check_on_fs:
+            certs = SignedCertificates(cache=cache).certnames()
+        elif not json_file and not check_on_fs:
+            certs = [c for c in fp.iter_certificates(state='valid') if match(c)]
+        else:
+            try:
+                with open(json_file) as data_file:
+                    jcerts = json.load(data_file)
+            except Exception as e:
+                print("Cant't decode json file: {}".format(e))
+                sys.exit(0)
+            certs = [cert.replace(".pem", "") for cert in jcerts if match(cert)]
+    # Every foreman host is still listed, only the certificates of the shard are deleted
+    certs = [cert for cert in certs if shard.owns(cert)]
+    run.processed(len(certs))
     foreman_hosts = []
 
-    result = foreman_wrapper(f.index_hosts, call_args={"per_page": 1000})
-    for host in result:
-        foreman_hosts.append(host["certname"])
+    for result in run.timed_iter('inventory', iter_foreman_hosts(f, cache)):
+        for host in result:
+            foreman_hosts.append(host["certname"])
 
     certs_to_delete = list(set(certs) - set(foreman_hosts))
 
     for cert in certs_to_delete:
-        try:
-            print(" {} will be deleted".format(cert))
-            fp.delete_certificate(cert)
-
-        except Exception as e:
-            print(" {} couldn't be deleted: {}".format(cert, e))
+        print(" {} will be deleted".format(cert))
+    with run.phase('deletion'):
+        results = fp.delete_certificates(certs_to_delete)
+    for cert, error in results.items():
+        if error:
+            print(" {} couldn't be deleted: {}".format(cert, error))
+            outcomes['certificates_delete_failed']['value'] += 1
+        else:
+            outcomes['certificates_deleted']['value'] += 1
+    run.finish(outcomes)
 
 
 @main.command()
@@ -122,37 +337,33 @@ def clean_ds():
     # Stats
     saved = 0
     deleted = 0
+    shard = sharding.current_shard()
+    run = metrics.Run('clean_ds', shard.grouping_key())
 
     # connect to Foreman and ForemanProxy
-    f = Foreman(FOREMAN_URL, (FOREMAN_USER, FOREMAN_PASSWORD), api_version=2)
+    f = connect_foreman()
 
     # Connect to the DS
-    try:
-        ds = AwsDs(LDAP_HOST, COMPUTERS_BASE_DN, BIND_USER_DN, BIND_PASSWORD)
-    except ldap.INVALID_CREDENTIALS:
-        raise "Your username or password is incorrect."
+    ds = connect_ds()
 
-    # Get all host from foreman
-    page = 1
-    result = []
-    last_len = 1
+    cache = open_cache()
 
-    while last_len > 0:
-        tmp_result = f.index_hosts(per_page="1000", page=str(page))['results']
-        last_len = len(tmp_result)
-        page += 1
-        result += tmp_result
-    foreman_hosts = {host["certname"]: host["ip"] for host in result}
+    # Get all host from foreman
+    foreman_hosts = {host["certname"]: host["ip"]
+                     for result in run.timed_iter('inventory', iter_foreman_hosts(f, cache)) for host in result}
 
     # Get all ds computer
     ds_computers = []
 
-    for c_dn, attr in ds.computers:
+    with run.phase('ldap_scan'):
+        computers = cached_ds_computers(cache, ds)
+    for c_dn, attr in computers:
         if 'dNSHostName' in attr and re.match('.*\.cloud\.coveo\.com$', attr['dNSHostName'][0]):
             ds_computers.append(attr['dNSHostName'][0].lower())
             continue
         else:
             ds_computers.append(build_from_cn(attr['cn'][0]))
+    run.processed(len(ds_computers))
 
     to_delete = ds_computers
 
@@ -166,22 +377,28 @@ def clean_ds():
     """
 
     # Exlude host that exist in foreman to the list of instances retrieve from the DS
-    for foreman_host in foreman_hosts.keys():
-        for i, ds_computer in enumerate(to_delete):
-            if re.match('^{}.*'.format(foreman_host), ds_computer):
-                del to_delete[i]
+    foreman_prefixes = PrefixSet(foreman_hosts.keys())
+    to_delete = [ds_computer for ds_computer in to_delete
+                 if shard.owns(ds_computer) and not foreman_prefixes.match(ds_computer)]
 
-    for host in to_delete:
-        try:
-            ip_address = socket.gethostbyname(host)
-            found = True
-        except:
-            found = False
+    # Resolve every leftover at once, then check them against EC2 in a single batched pass
+    with run.phase('dns_resolution'):
+        ip_addresses = resolve_hostnames(to_delete, timeout=DNS_TIMEOUT, concurrency=DNS_CONCURRENCY)
+    with run.phase('ec2_resolution'):
+        ec2_states = Ec2StateResolver()
+        ec2_states.resolve(ips=[ip for ip in ip_addresses.values() if ip not in (None, UNKNOWN)])
 
+    for host in to_delete:
+        ip_address = ip_addresses.get(host)
+        # Only a host without any DNS record is deleted without checking EC2
+        if ip_address is UNKNOWN:
+            print("{} could not be resolved, ignoring this instance".format(host))
+            saved += 1
+            continue
         # Make the following 2 call only at the end in order to avoid useless consuming API call
         try:
-            if found:
-                is_terminated = (get_ec2_instance_state(
+            if ip_address is not None:
+                is_terminated = (ec2_states.get_state(
                     '', ip=ip_address) == 'terminated')
                 if not is_terminated:
                     print("{} is not terminated, ignoring this instance".format(host))
@@ -189,12 +406,23 @@ def clean_ds():
                     continue
             logging.info("I will destroy the server {}".format(host))
             # remove host in the DS
-            ds.delete_computer(host)
+            with run.phase('deletion'):
+                delete_ds_computer(ds, cache, host)
             deleted += 1
         except Exception as e:
             logging.error("Something went wrong : {}".format(e))
     logging.info("{} instances deleted\n{} instances saved\n{} instances in foreman\n".format(
         deleted, saved, len(foreman_hosts)))
+    run.finish({
+        'ds_deleted': {
+            'description': 'count of computers deleted from the ds',
+            'value': deleted
+        },
+        'ds_saved': {
+            'description': 'count of computers kept in the ds because their instance is running or did not resolve',
+            'value': saved
+        },
+    })
 
 
 @main.command()
@@ -202,7 +430,9 @@ def clean_old_host():
     """ Method call by cron to clean instances """
     logging.info("########## Start Cleaning ###########")
 
-    metrics = {
+    shard = sharding.current_shard()
+    run = metrics.Run('clean_old_host', shard.grouping_key())
+    outcomes = {
         'hosts_ok': {
             'description': 'count of hosts which have a report in the defined delay',
             'value': 0
@@ -222,55 +452,105 @@ def clean_old_host():
     }
 
     # connect to Foreman and ForemanProxy
-    f = Foreman(FOREMAN_URL, (FOREMAN_USER, FOREMAN_PASSWORD), api_version=2)
-    fp = ForemanProxy(FOREMAN_PROXY_URL)
+    f = connect_foreman()
+    fp = connect_foreman_proxy()
 
     # Connect to the DS
-    try:
-        ds = AwsDs(LDAP_HOST, COMPUTERS_BASE_DN, BIND_USER_DN, BIND_PASSWORD)
-    except ldap.INVALID_CREDENTIALS:
-        raise "Your username or password is incorrect."
+    ds = connect_ds()
 
     # Get the the current date
     currentdate = datetime.datetime.utcnow()
 
-    # check for all host
-    instance_id_dict = foreman_wrapper(f.do_get, call_args={'url': '/api/fact_values?&search=+name+%3D+ec2_instance_id',
-                                                            'kwargs': {'per_page': 1000}})
-    result = foreman_wrapper(f.index_hosts, call_args={"per_page": 1000})
-    for host in result:
-        # get the compile date
-        lastcompile = None
-        if host["last_compile"]:
-            lastcompile = host["last_compile"]
-        elif host["last_report"]:
-            lastcompile = host["last_report"]
-        elif host["created_at"]:
-            lastcompile = host["created_at"]
-
-        # Convert the string date to datetime format
-        if not host["last_compile"] and not host["last_report"] and host["created_at"]:
-            logging.info("Can't retrieve last compile/report date for {}, will use create time ({})".format(
-                host["certname"], host["created_at"]))
-
-        hostdate = datetime.datetime.strptime(
-            lastcompile, '%Y-%m-%dT%H:%M:%S.%fZ')
-        # Get the delta between the last puppet repport and the current date
-        elapsed = currentdate - hostdate
-        # if the deta is more than $delay days we delete the host
-        if elapsed > datetime.timedelta(hours=int(DELAY)):
-            # Make the following 2 call only at the end in order to avoid useless consuming API call
+    cache = open_cache()
+    if cache is not None:
+        # Look up the DS deletions in the cached snapshot instead of searching the whole DS
+        with run.phase('ldap_scan'):
+            cached_ds_computers(cache, ds)
+
+    # Each host is destroyed in foreman, then its certificate is removed from puppet, then it is removed from the DS
+    deletions = DeletionExecutor([
+        (Backend('foreman', FOREMAN_CONCURRENCY, DELETE_RETRIES), lambda h: destroy_foreman_host(f, cache, h)),
+        (Backend('puppet', PUPPET_CONCURRENCY, DELETE_RETRIES), lambda h: fp.delete_certificate(h["certname"])),
+        (Backend('ds', DS_CONCURRENCY, DELETE_RETRIES, fatal=(NotFound, TooManyResult)),
+         lambda h: delete_ds_computer(ds, cache, h["certname"])),
+    ], workers=DELETE_WORKERS)
+
+    # The instance ids are only fetched for the stale hosts of each page, the cache keeps them between runs
+    with run.phase('facts'):
+        instance_id_dict = cached_instance_ids(cache)
+    # Foreman only returns the hosts without a recent report, they are verified below before being deleted
+    stale_search = 'last_report < "{} hours ago" or not has last_report'.format(int(DELAY))
+    stale_limit = currentdate - datetime.timedelta(hours=int(DELAY))
+
+    def is_stale(host):
+        # Same selection as the search, for the hosts read from the cache
+        return not host["last_report"] or datetime.datetime.strptime(
+            host["last_report"], '%Y-%m-%dT%H:%M:%S.%fZ') < stale_limit
+
+    totals = {}
+    # Hosts are evaluated page by page while the next page is fetched, the deletions start with the first page
+    for result in run.timed_iter('inventory', iter_foreman_hosts(f, cache, search=stale_search, totals=totals,
+                                                                 by_id=True, matches=is_stale)):
+        result = [host for host in result if shard.owns(host["certname"])]
+        run.processed(len(result))
+        stale_hosts = []
+        for host in result:
+            # get the compile date
+            lastcompile = None
+            if host["last_compile"]:
+                lastcompile = host["last_compile"]
+            elif host["last_report"]:
+                lastcompile = host["last_report"]
+            elif host["created_at"]:
+                lastcompile = host["created_at"]
+
+            # Convert the string date to datetime format
+            if not host["last_compile"] and not host["last_report"] and host["created_at"]:
+                logging.info("Can't retrieve last compile/report date for {}, will use create time ({})".format(
+                    host["certname"], host["created_at"]))
+
+            hostdate = datetime.datetime.strptime(
+                lastcompile, '%Y-%m-%dT%H:%M:%S.%fZ')
+            # Get the delta between the last puppet repport and the current date
+            elapsed = currentdate - hostdate
+            # if the deta is more than $delay days we delete the host
+            if elapsed > datetime.timedelta(hours=int(DELAY)):
+                stale_hosts.append((host, lastcompile))
+            else:
+                outcomes["hosts_ok"]["value"] += 1
+                logging.debug("{} OK: Last puppet's run : {}".format(
+                    host["certname"], lastcompile))
+
+        with run.phase('facts'):
+            fetched = fetch_instance_ids(f, [host['name'] for host, _ in stale_hosts], instance_id_dict)
+            if cache is not None:
+                cache_instance_ids(cache, fetched)
+
+        # Resolve the EC2 state of every stale host of the page at once in order to avoid one API call per host
+        ec2_states = Ec2StateResolver()
+        instance_ids, ips = [], []
+        for host, _ in stale_hosts:
+            instance_id = instance_id_dict.get(host['name'], {}).get('ec2_instance_id')
+            if instance_id:
+                instance_ids.append(instance_id)
+            elif host['ip']:
+                ips.append(host['ip'])
+        with run.phase('ec2_resolution'):
+            ec2_states.resolve(instance_ids=instance_ids, ips=ips)
+
+        terminated_hosts = []
+        for host, lastcompile in stale_hosts:
             try:
                 instance_id = instance_id_dict[host['name']]['ec2_instance_id']
-                is_terminated = (get_ec2_instance_state(
+                is_terminated = (ec2_states.get_state(
                     instance_id) == 'terminated')
             except KeyError:
                 if host['ip']:
-                    is_terminated = (get_ec2_instance_state(
+                    is_terminated = (ec2_states.get_state(
                         '', ip=host['ip']) == 'terminated')
                 elif host['mac']:
-                    is_terminated = (get_ec2_instance_state(
-                        '', ip=host['ip'], mac=host['mac']) == 'terminated')
+                    # The network interface of a mac is not looked up, such a host is considered terminated
+                    is_terminated = True
                 else:
                     logging.warning(
                         "Can't retrieve EC2 id or ip, will destroy {}".format(host["certname"]))
@@ -278,32 +558,71 @@ def clean_old_host():
             except Exception as e:
                 logging.warning(
                     "Can't retrieve EC2 state, skipping {} : {}".format(host["certname"], e))
-                metrics["hosts_skipped"]["value"] += 1
+                outcomes["hosts_skipped"]["value"] += 1
                 continue
 
             if is_terminated:
-                try:
-                    logging.info("I will destroy the server {} because the last report was {}".format(
-                        host["certname"], str(lastcompile)))
-                    # destroy the host in foreman
-                    f.destroy_hosts(id=host["id"])
-                    # remove the certificate in puppet
-                    fp.delete_certificate(host["certname"])
-                    # remove host in the DS
-                    ds.delete_computer(host["certname"])
-                    metrics["hosts_deleted"]["value"] += 1
-                except Exception as e:
-                    logging.error("Something went wrong : {}".format(e))
-                    metrics["hosts_delete_failed"]["value"] += 1
+                logging.info("I will destroy the server {} because the last report was {}".format(
+                    host["certname"], str(lastcompile)))
+                terminated_hosts.append(host)
             else:
-                metrics["hosts_skipped"]["value"] += 1
+                outcomes["hosts_skipped"]["value"] += 1
+        for host in terminated_hosts:
+            deletions.submit(host)
+
+    # The hosts left out by the search have a recent report, they are not split between the shards
+    if shard.leader:
+        recent = totals.get('total', 0) - totals.get('subtotal', 0)
+        outcomes["hosts_ok"]["value"] += recent
+        run.processed(recent)
+
+    for host, error in run.timed_iter('deletion', deletions.results()):
+        if error:
+            logging.error("Something went wrong with {} : {}".format(host["certname"], error))
+            outcomes["hosts_delete_failed"]["value"] += 1
         else:
-            metrics["hosts_ok"]["value"] += 1
-            logging.debug("{} OK: Last puppet's run : {}".format(
-                host["certname"], lastcompile))
+            outcomes["hosts_deleted"]["value"] += 1
 
     logging.info("Push metrics to prometheus")
-    push_metrics(metrics)
+    run.finish(outcomes)
+
+
+def command_job(group, name, args):
+    command = group.get_command(None, name)
+
+    def run():
+        command.invoke(command.make_context(name, list(args)))
+    return run
+
+
+@main.command()
+@click.option("--config_file", '-c', default='/install/config.yaml', help="Config file of the check-join job")
+def serve(config_file):
+    """ Run every job on its schedule in a single process keeping its clients between runs """
+    clients.keep_warm()
+    if sharding.SHARD_LEASE_DIR:
+        sharding.keep_lease()
+    grouping_key = {'command': 'serve'}
+    if sharding.SHARD_LEASE_DIR:
+        grouping_key['shard'] = sharding.SHARD_NAME
+    elif sharding.SHARD_COUNT > 1:
+        grouping_key['shard'] = str(sharding.SHARD_INDEX)
+    metrics.share_backend_metrics(grouping_key)
+    if METRICS_PORT:
+        # The runs are still pushed to the gateway, the endpoint also exposes the last run of each job
+        metrics.serve(int(METRICS_PORT))
+    scheduler = Scheduler()
+    jobs = [
+        (main, 'clean-old-host', CLEAN_OLD_HOST_SCHEDULE, []),
+        (main, 'clean-old-certificates', CLEAN_OLD_CERTIFICATES_SCHEDULE, []),
+        (main, 'clean-ds', CLEAN_DS_SCHEDULE, []),
+    ]
+    if os.path.exists(config_file):
+        jobs.append((check_windows.main, 'check-join', CHECK_JOIN_SCHEDULE, ['-c', config_file]))
+    for group, name, schedule, args in jobs:
+        scheduler.add(name, schedule, command_job(group, name, args))
+        logging.info("Scheduled {} at '{}'".format(name, schedule))
+    scheduler.run_forever()
 
 
 # Read option
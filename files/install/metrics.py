@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import profiling
+import ratelimit
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, push_to_gateway, start_http_server
+from prometheus_client.core import Metric
+
+PROMETHEUS_ENDPOINT = os.environ.get('PROMETHEUS_ENDPOINT')
+INSTANCE = 'k8s-foreman-cleaner'
+
+# Backend metrics are shared by every run of the process
+_backend_registry = CollectorRegistry()
+BACKEND_CALLS = Counter('foreman_cleaner_backend_calls_total', 'count of calls made to a backend',
+                        ['backend', 'operation'], registry=_backend_registry)
+BACKEND_ERRORS = Counter('foreman_cleaner_backend_errors_total', 'count of calls to a backend which failed',
+                         ['backend', 'operation'], registry=_backend_registry)
+BACKEND_LATENCY = Histogram('foreman_cleaner_backend_call_duration_seconds', 'duration of the calls made to a backend',
+                            ['backend', 'operation'], registry=_backend_registry)
+
+# Registry of the last finished run of each command, exposed by the pull endpoint
+_latest_runs = {}
+# Grouping key of the backend metrics when one process runs every command, they are then pushed apart from the runs
+_process_grouping_key = None
+
+
+class _Forward(object):
+    """ Expose the metrics of other registries in a registry """
+
+    def __init__(self, *registries):
+        self.registries = registries
+
+    def collect(self):
+        for registry in self.registries:
+            for metric in registry.collect():
+                yield metric
+
+
+class _LatestRuns(object):
+    """ Expose the last run of each command, the families defined by every run are merged into one """
+
+    def collect(self):
+        families = {}
+        for registry in list(_latest_runs.values()):
+            for metric in registry.collect():
+                if metric.name not in families:
+                    families[metric.name] = Metric(metric.name, metric.documentation, metric.type)
+                families[metric.name].samples.extend(metric.samples)
+        return list(families.values())
+
+
+@contextmanager
+def track(backend, operation):
+    """
+    Count and time a call made to a backend, once allowed by the limiter of the backend. The call is also a span of
+    the trace when one is recorded.
+    Ex: with track('ec2', 'describe_instances'): ...
+    """
+    with ratelimit.limited(backend), profiling.span(backend, operation):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            BACKEND_ERRORS.labels(backend, operation).inc()
+            raise
+        finally:
+            BACKEND_CALLS.labels(backend, operation).inc()
+            BACKEND_LATENCY.labels(backend, operation).observe(time.time() - start)
+
+
+class Run(object):
+    def __init__(self, command, grouping_key=None):
+        """
+        Metrics of a single run of a command, pushed once when the run is finished
+        :param command: Name of the command. Ex: "clean_old_host"
+        :param grouping_key: Labels added to the command to group the pushed metrics
+        """
+        self.command = command
+        self.grouping_key = dict(grouping_key or {}, command=command)
+        self.registry = CollectorRegistry()
+        self._start = time.time()
+        self._phases = {}
+        self._processed = 0
+        self._lock = threading.Lock()
+        self._phase_duration = Histogram('foreman_cleaner_phase_duration_seconds', 'time spent in each phase of a run',
+                                         ['command', 'phase'], registry=self.registry,
+                                         buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+        self._run_duration = Gauge('foreman_cleaner_run_duration_seconds', 'duration of the last run',
+                                   ['command'], registry=self.registry)
+        self._throughput = Gauge('foreman_cleaner_items_per_second', 'items processed per second by the last run',
+                                 ['command'], registry=self.registry)
+
+    @contextmanager
+    def phase(self, name):
+        """ Add the time spent in the block to a phase, a phase can be entered many times in a run """
+        start = time.time()
+        try:
+            with profiling.span('phase', name):
+                yield
+        finally:
+            self._add_phase(name, time.time() - start)
+
+    def _add_phase(self, name, seconds):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0) + seconds
+
+    def timed_iter(self, name, iterable):
+        """ Add the time spent waiting for each item of iterable to a phase, the waits are not traced one by one """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._add_phase(name, time.time() - start)
+            yield item
+
+    def processed(self, count=1):
+        with self._lock:
+            self._processed += count
+
+    def finish(self, outcomes=None):
+        """
+        Record the run metrics and push them with the backend metrics in a single push
+        :param outcomes: A dict name -> {'description', 'value'} of counts exported as foreman_cleaner_<name>
+        """
+        duration = time.time() - self._start
+        profiling.record('command', self.command, self._start, duration, processed=self._processed)
+        for name, seconds in self._phases.items():
+            self._phase_duration.labels(self.command, name).observe(seconds)
+        self._run_duration.labels(self.command).set(duration)
+        self._throughput.labels(self.command).set(self._processed / duration if duration else 0)
+        for name, config in (outcomes or {}).items():
+            g = Gauge("foreman_cleaner_{}".format(name), config['description'], registry=self.registry,
+                      labelnames=["instance"])
+            g.labels(instance=INSTANCE).set(config["value"])
+
+        _latest_runs[self.command] = self.registry
+        if not PROMETHEUS_ENDPOINT:
+            return
+        if _process_grouping_key is None:
+            # The process only runs this command, its backend calls are the calls of the run
+            registry = CollectorRegistry()
+            registry.register(_Forward(self.registry, _backend_registry))
+            push_to_gateway(PROMETHEUS_ENDPOINT, job="foreman_cleaner", registry=registry,
+                            grouping_key=self.grouping_key)
+        else:
+            push_to_gateway(PROMETHEUS_ENDPOINT, job="foreman_cleaner", registry=self.registry,
+                            grouping_key=self.grouping_key)
+            push_to_gateway(PROMETHEUS_ENDPOINT, job="foreman_cleaner", registry=_backend_registry,
+                            grouping_key=_process_grouping_key)
+
+
+def share_backend_metrics(grouping_key):
+    """
+    The process runs every command, its backend metrics are pushed in a group of their own instead of with each
+    run, otherwise every command group would count the calls of the others
+    :param grouping_key: Labels of the group of the backend metrics. Ex: {"command": "serve"}
+    """
+    global _process_grouping_key
+    _process_grouping_key = dict(grouping_key)
+
+
+def serve(port):
+    """ Expose the backend metrics and the last run of each command for scraping """
+    registry = CollectorRegistry()
+    registry.register(_Forward(_backend_registry))
+    registry.register(_LatestRuns())
+    start_http_server(port, registry=registry)
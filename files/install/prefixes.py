@@ -0,0 +1,47 @@
+from bisect import bisect_left, insort
+
+
+class SortedPrefixIndex(object):
+    """ Sorted (key, value) pairs answering "which keys start with this prefix" in O(log n) """
+
+    def __init__(self, items=()):
+        self._items = sorted(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, key, value):
+        insort(self._items, (key, value))
+
+    def remove(self, key, value):
+        i = bisect_left(self._items, (key, value))
+        if i < len(self._items) and self._items[i] == (key, value):
+            del self._items[i]
+
+    def startswith(self, prefix):
+        """ Return the values of every key starting with prefix """
+        found = []
+        i = bisect_left(self._items, (prefix,))
+        while i < len(self._items) and self._items[i][0].startswith(prefix):
+            found.append(self._items[i][1])
+            i += 1
+        return found
+
+
+class PrefixSet(object):
+    """ Set of prefixes answering "does any of them start this name" with one lookup per distinct prefix length """
+
+    def __init__(self, prefixes=()):
+        self._prefixes = set(prefixes)
+        self._lengths = sorted(set(len(p) for p in self._prefixes))
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def match(self, name):
+        for length in self._lengths:
+            if length > len(name):
+                break
+            if name[:length] in self._prefixes:
+                return True
+        return False
@@ -0,0 +1,137 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Both are only set while a run is profiled or traced, every function is a no-op otherwise
+_trace = None
+_profile = None
+
+
+class _Trace(object):
+    def __init__(self, path):
+        """
+        Spans recorded in the Chrome trace format, the file can be opened in chrome://tracing or speedscope
+        :param path: Path of the trace file
+        """
+        self.path = path
+        self.start = time.time()
+        self.events = []
+        self.threads = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def stack(self):
+        """ Spans open in the current thread, the innermost last """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def add(self, category, name, start, duration, args):
+        thread = threading.current_thread()
+        event = {'name': '{} {}'.format(category, name), 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                 'tid': thread.ident, 'ts': int((start - self.start) * 1e6), 'dur': int(duration * 1e6),
+                 'args': args}
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def write(self):
+        with self._lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                     for tid, name in self.threads.items()]
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Profile(object):
+    def __init__(self, path):
+        """
+        Deterministic profile of every thread, cProfile only follows the thread which enabled it
+        :param path: Path of the file receiving the pstats of the run
+        """
+        self.path = path
+        self.profiles = []
+        threading.setprofile(self._profile_thread)
+        self._profile_thread()
+
+    def _profile_thread(self, *args):
+        # Called at the first event of a new thread, the profiler of the thread then replaces it
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        profile.enable()
+
+    def write(self):
+        threading.setprofile(None)
+        for profile in self.profiles:
+            profile.create_stats()
+        stats = pstats.Stats(*[p for p in self.profiles if p.stats])
+        stats.dump_stats(self.path)
+        stats.sort_stats('cumulative').print_stats(25)
+
+
+def start(profile=None, trace_file=None):
+    """
+    :param profile: Path of the file receiving the pstats of the run, no profile is recorded when not set
+    :param trace_file: Path of the file receiving the spans of the run, no span is recorded when not set
+    """
+    global _trace, _profile
+    if trace_file:
+        _trace = _Trace(trace_file)
+    if profile:
+        _profile = _Profile(profile)
+
+
+def stop():
+    """ Write the profile and the trace """
+    global _trace, _profile
+    if _profile is not None:
+        _profile.write()
+        logging.info("Profile written to {}".format(_profile.path))
+        _profile = None
+    if _trace is not None:
+        _trace.write()
+        logging.info("Trace written to {}".format(_trace.path))
+        _trace = None
+
+
+@contextmanager
+def span(category, name):
+    """ Record the block as a span of the trace. Ex: with span('foreman', 'index_hosts'): ... """
+    trace = _trace
+    if trace is None:
+        yield
+        return
+    args = {}
+    stack = trace.stack()
+    stack.append(args)
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        trace.add(category, name, start, time.time() - start, args)
+
+
+def record(category, name, start, duration, **args):
+    """ Record a span which already ended """
+    trace = _trace
+    if trace is not None:
+        trace.add(category, name, start, duration, args)
+
+
+def annotate(**args):
+    """ Add arguments to the innermost span of the current thread. Ex: annotate(bytes=len(response.content)) """
+    trace = _trace
+    if trace is None:
+        return
+    stack = trace.stack()
+    if stack:
+        stack[-1].update(args)
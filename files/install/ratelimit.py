@@ -0,0 +1,143 @@
+import ldap
+import os
+import requests
+import threading
+import time
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+
+# Error codes of the AWS APIs asking to slow down
+THROTTLING_CODES = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException',
+                    'RequestThrottled', 'SlowDown']
+
+
+def _limits(backend, rate, concurrency):
+    """ Read the limits of a backend from <BACKEND>_RATE_LIMIT and <BACKEND>_MAX_CONCURRENCY """
+    prefix = backend.upper()
+    return float(os.getenv(prefix + '_RATE_LIMIT', rate)), int(os.getenv(prefix + '_MAX_CONCURRENCY', concurrency))
+
+
+# Calls per second (0 for no limit) and maximum concurrent calls of each backend, other backends are not limited
+LIMITS = {
+    'foreman': _limits('foreman', 0, 16),
+    'foreman_proxy': _limits('foreman_proxy', 0, 10),
+    'ec2': _limits('ec2', 0, 20),
+    'sts': _limits('sts', 0, 4),
+    'ldap': _limits('ldap', 0, 8),
+}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Number of operations allowed per second
+        :param burst: Number of operations which can be done at once after an idle period
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until an operation is allowed """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+    def __init__(self, rate, max_concurrency, cooldown=1.0):
+        """
+        Limit the calls made to a backend with additive increase, multiplicative decrease: each throttled call
+        halves the allowed concurrency and rate, each successful call raises them slowly back to their maximum
+        :param rate: Maximum number of calls per second, 0 for no limit
+        :param max_concurrency: Maximum number of calls running at the same time
+        :param cooldown: Minimum delay in seconds between two decreases, the calls throttled together only
+                         count once
+        """
+        self.max_rate = float(rate)
+        self.max_concurrency = max_concurrency
+        self.cooldown = cooldown
+        self.concurrency = float(max_concurrency)
+        self._bucket = TokenBucket(rate, burst=max_concurrency) if rate else None
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        if self._bucket is not None:
+            self._bucket.acquire()
+        with self._cond:
+            while self._in_flight >= int(self.concurrency):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.time()
+            if throttled:
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    if self._bucket is not None:
+                        self._bucket.rate = max(self.max_rate / 100, self._bucket.rate / 2)
+            else:
+                # Grow by about one call per window of calls
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                if self._bucket is not None:
+                    self._bucket.rate = min(self.max_rate, self._bucket.rate + self.max_rate / 100)
+            self._cond.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(backend):
+    """ Return the limiter shared by every call to a backend, None when the backend is not limited """
+    if backend not in LIMITS:
+        return None
+    with _limiters_lock:
+        if backend not in _limiters:
+            _limiters[backend] = AdaptiveLimiter(*LIMITS[backend])
+        return _limiters[backend]
+
+
+def is_throttling(error):
+    """ Return True when the error means the backend asks to slow down """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLING_CODES
+    if isinstance(error, (ldap.BUSY, ldap.UNAVAILABLE)):
+        return True
+    return getattr(error, 'status_code', None) in (429, 503)
+
+
+def is_retryable(error):
+    """ Return True for throttling and server errors, which may succeed later """
+    return (is_throttling(error) or getattr(error, 'status_code', 0) >= 500 or
+            isinstance(error, requests.ConnectionError))
+
+
+@contextmanager
+def limited(backend):
+    """ Wait for the limiter of the backend before the call, and adapt the limits to its outcome """
+    limiter = get_limiter(backend)
+    if limiter is None:
+        yield
+        return
+    limiter.acquire()
+    try:
+        yield
+    except Exception as e:
+        limiter.release(throttled=is_throttling(e))
+        raise
+    limiter.release()
@@ -0,0 +1,51 @@
+import re
+from collections import namedtuple
+
+# Every bucket is a sorted list, joined and unjoined hold dns names, need_repair and stopped hold cns
+JoinReport = namedtuple('JoinReport', ['joined', 'unjoined', 'need_repair', 'stopped'])
+
+
+def compile_filters(patterns):
+    """
+    Compile the search filters into a single matcher
+    :param patterns: Substrings, a name matches when it contains any of them
+    :return: A function name -> bool
+    """
+    if not patterns:
+        return lambda name: False
+    regex = re.compile('|'.join(re.escape(p) for p in patterns))
+    return lambda name: regex.search(name) is not None
+
+
+def reconcile(ds_computers, ec2_instances, match):
+    """
+    Classify the machines matched by the search filters in a single pass over each inventory
+    :param ds_computers: A dict cn -> list of dNSHostName, or None when the computer has none
+    :param ec2_instances: A dict dns name -> {'status', 'cn', ...} as returned by get_instances_from_ec2
+    :param match: A matcher returned by compile_filters
+    :return: A JoinReport
+    """
+    ds_names = set()
+    ds_without_dns = set()
+    for cn, dns_names in ds_computers.items():
+        if dns_names:
+            name = dns_names[0].lower()
+            if match(name):
+                ds_names.add(name)
+        elif match(cn):
+            ds_without_dns.add(cn)
+
+    ec2_names = set()
+    status_by_cn = {}
+    for name, infos in ec2_instances.items():
+        if match(name):
+            ec2_names.add(name)
+            status_by_cn[infos['cn']] = infos['status']
+
+    # A computer without dns name which exists in EC2 has lost its secure channel
+    repair = ds_without_dns & set(status_by_cn)
+    need_repair = set(cn for cn in repair if status_by_cn[cn] == 'running')
+    unjoined = set(name for name in ec2_names - ds_names if ec2_instances[name]['cn'] not in repair)
+
+    return JoinReport(joined=sorted(ec2_names & ds_names), unjoined=sorted(unjoined),
+                      need_repair=sorted(need_repair), stopped=sorted(repair - need_repair))
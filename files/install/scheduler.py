@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+
+
+def _parse_field(field, low, high):
+    """ Parse a cron field supporting *, lists, ranges and steps. Ex: "*/15", "1,30", "8-18" """
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(v) for v in part.split('-')]
+        else:
+            start = end = int(part)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    def __init__(self, expression):
+        """
+        :param expression: A cron expression "minute hour day_of_month month day_of_week". Ex: "30 * * * *"
+        """
+        minute, hour, dom, month, dow = expression.split()
+        self.expression = expression
+        self.minutes = _parse_field(minute, 0, 59)
+        self.hours = _parse_field(hour, 0, 23)
+        self.days = _parse_field(dom, 1, 31)
+        self.months = _parse_field(month, 1, 12)
+        # cron accepts 0 and 7 for sunday
+        self.weekdays = set(d % 7 for d in _parse_field(dow, 0, 7))
+
+    def match(self, t):
+        """ :param t: A time.struct_time """
+        # struct_time counts week days from monday=0 where cron counts from sunday=0
+        return (t.tm_min in self.minutes and t.tm_hour in self.hours and t.tm_mday in self.days and
+                t.tm_mon in self.months and (t.tm_wday + 1) % 7 in self.weekdays)
+
+
+class Job(object):
+    def __init__(self, name, schedule, func):
+        self.name = name
+        self.schedule = CronSchedule(schedule)
+        self.func = func
+        self._running = threading.Lock()
+
+    def start(self):
+        """ Run the job in a thread, unless the previous run is not finished yet """
+        if not self._running.acquire(False):
+            logging.warning("{} is still running, skipping this run".format(self.name))
+            return None
+        t = threading.Thread(target=self._run, name=self.name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _run(self):
+        try:
+            logging.info("Starting job {}".format(self.name))
+            self.func()
+            logging.info("Job {} finished".format(self.name))
+        except BaseException as e:
+            # SystemExit included, a job must never stop the scheduler
+            logging.error("Job {} failed : {}".format(self.name, e))
+        finally:
+            self._running.release()
+
+
+class Scheduler(object):
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, name, schedule, func):
+        self.jobs.append(Job(name, schedule, func))
+
+    def run_forever(self):
+        last_minute = None
+        while True:
+            # Wake up at the start of each minute, tolerating a sleep ending slightly early
+            time.sleep(60 - time.time() % 60)
+            minute = int((time.time() + 1) // 60)
+            if minute == last_minute:
+                continue
+            last_minute = minute
+            now = time.localtime(minute * 60)
+            for job in self.jobs:
+                if job.schedule.match(now):
+                    job.start()
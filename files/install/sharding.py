@@ -0,0 +1,122 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+# Static sharding: each replica is given its index, sharding is disabled with a single shard
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+# Dynamic sharding: the shards are the replicas holding a lease in a shared directory
+SHARD_LEASE_DIR = os.environ.get('SHARD_LEASE_DIR')
+SHARD_LEASE_TTL = int(os.getenv('SHARD_LEASE_TTL', '7200'))
+SHARD_NAME = os.getenv('SHARD_NAME', socket.gethostname())
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    def __init__(self, members, replicas=100):
+        """
+        Consistent hash ring, removing a member only moves the keys it owned
+        :param members: Names of the members
+        :param replicas: Number of points of each member on the ring, more points spread the keys more evenly
+        """
+        self._points = sorted((_hash('{}-{}'.format(member, i)), member)
+                              for member in members for i in range(replicas))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._points[i][1]
+
+
+class Shard(object):
+    def __init__(self, name, members):
+        """
+        Slice of the certname space owned by a replica
+        :param name: Name of the replica
+        :param members: Names of every replica, including this one
+        """
+        self.name = name
+        self.members = sorted(members)
+        self._ring = HashRing(self.members)
+
+    @property
+    def enabled(self):
+        return len(self.members) > 1
+
+    @property
+    def leader(self):
+        """ A single replica is leader, it reports what can't be split between the shards """
+        return self.members[0] == self.name
+
+    def owns(self, certname):
+        return not self.enabled or self._ring.owner(certname.lower()) == self.name
+
+    def grouping_key(self):
+        """ Prometheus grouping key keeping the runs of each shard apart """
+        return {'shard': self.name} if self.enabled else {}
+
+
+def renew_lease(lease_dir=None, name=None):
+    lease_dir = lease_dir or SHARD_LEASE_DIR
+    lease = os.path.join(lease_dir, '{}.lease'.format(name or SHARD_NAME))
+    # Replace the lease atomically so that other replicas never read a partial file
+    tmp = '{}.tmp'.format(lease)
+    with open(tmp, 'w') as f:
+        f.write(str(time.time()))
+    os.rename(tmp, lease)
+
+
+def live_replicas(lease_dir=None, ttl=None):
+    """ Names of the replicas whose lease was renewed in the last ttl seconds """
+    lease_dir = lease_dir or SHARD_LEASE_DIR
+    ttl = ttl or SHARD_LEASE_TTL
+    now = time.time()
+    names = []
+    for filename in os.listdir(lease_dir):
+        if not filename.endswith('.lease'):
+            continue
+        try:
+            age = now - os.path.getmtime(os.path.join(lease_dir, filename))
+        except OSError:
+            # Removed since listed
+            continue
+        if age < ttl:
+            names.append(filename[:-len('.lease')])
+    return names
+
+
+def keep_lease(interval=None):
+    """ Renew the lease of this replica in the background, for a process running for a long time """
+    interval = interval or SHARD_LEASE_TTL / 4.0
+
+    def renew():
+        while True:
+            try:
+                renew_lease()
+            except (IOError, OSError) as e:
+                logging.error("Can't renew the shard lease: {}".format(e))
+            time.sleep(interval)
+    t = threading.Thread(target=renew, name='shard-lease')
+    t.daemon = True
+    t.start()
+
+
+def current_shard():
+    """ Return the shard of this replica, the shards are rebalanced when a lease appears or expires """
+    if SHARD_LEASE_DIR:
+        renew_lease()
+        shard = Shard(SHARD_NAME, live_replicas())
+    else:
+        if not 0 <= SHARD_INDEX < SHARD_COUNT:
+            raise ValueError("SHARD_INDEX must be between 0 and SHARD_COUNT - 1")
+        shard = Shard(str(SHARD_INDEX), [str(i) for i in range(SHARD_COUNT)])
+    if shard.enabled:
+        logging.info("Shard {} of {} replicas: {}".format(shard.name, len(shard.members), ', '.join(shard.members)))
+    return shard
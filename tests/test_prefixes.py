@@ -0,0 +1,55 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'install'))
+
+from prefixes import PrefixSet  # noqa: E402
+
+DOMAIN = 'cloud.coveo.com'
+ENVIRONMENTS = ['ndev', 'nsta', 'nprd', 'nqa', 'win', 'npra-al', 'npra-aw']
+
+
+def random_certname(rng):
+    return '{}-{}{}.{}'.format(rng.choice(ENVIRONMENTS), rng.choice(['app', 'es', 'db', 'web']),
+                               rng.randint(0, 300), DOMAIN)
+
+
+def excluded_by_brute_force(certnames, ds_computers):
+    """ The clean_ds exclusion loop without its skipped entries: keep the names no certname starts """
+    return [name for name in ds_computers if not any(name.startswith(certname) for certname in certnames)]
+
+
+class PrefixSetTest(unittest.TestCase):
+    def test_match_is_startswith_any_prefix(self):
+        rng = random.Random(42)
+        for _ in range(50):
+            certnames = set(random_certname(rng) for _ in range(rng.randint(0, 200)))
+            ds_computers = []
+            for certname in rng.sample(sorted(certnames), len(certnames) // 2):
+                # The same host, a longer name starting with it and a truncated name
+                ds_computers.extend([certname, certname + '.extra', certname[:rng.randint(1, len(certname))]])
+            ds_computers.extend(random_certname(rng) for _ in range(rng.randint(0, 200)))
+            rng.shuffle(ds_computers)
+
+            prefixes = PrefixSet(certnames)
+            self.assertEqual([name for name in ds_computers if not prefixes.match(name)],
+                             excluded_by_brute_force(certnames, ds_computers))
+
+    def test_prefixes_of_any_length(self):
+        prefixes = PrefixSet(['a', 'abc', 'xyz'])
+        self.assertTrue(prefixes.match('a'))
+        self.assertTrue(prefixes.match('abd'))
+        self.assertTrue(prefixes.match('xyz.cloud'))
+        self.assertFalse(prefixes.match('xy'))
+        self.assertFalse(prefixes.match(''))
+        self.assertFalse(PrefixSet().match('anything'))
+
+    def test_prefix_is_literal(self):
+        # The old unescaped regex also let '.' match any character
+        self.assertFalse(PrefixSet(['ndev.app']).match('ndevxapp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files', 'install'))
+
+from reconcile import compile_filters, reconcile  # noqa: E402
+
+DOMAIN = 'cloud.coveo.com'
+
+
+def instance(cn, status='running'):
+    """ An entry of get_instances_from_ec2, the cns are lower case like the keys of the DS computers """
+    return {'cn': cn, 'status': status}
+
+
+class ReconcileTest(unittest.TestCase):
+    def test_name_matched_by_several_filters_is_listed_once(self):
+        match = compile_filters(['win', 'win-app', 'app'])
+        ds_computers = {'win-app1': ['WIN-APP1.{}'.format(DOMAIN)]}
+        ec2_instances = {'win-app1.{}'.format(DOMAIN): instance('win-app1'),
+                         'win-app2.{}'.format(DOMAIN): instance('win-app2')}
+
+        report = reconcile(ds_computers, ec2_instances, match)
+
+        self.assertEqual(report.joined, ['win-app1.{}'.format(DOMAIN)])
+        self.assertEqual(report.unjoined, ['win-app2.{}'.format(DOMAIN)])
+
+    def test_consecutive_need_repair_entries_are_removed_from_unjoined(self):
+        match = compile_filters(['win'])
+        ds_computers = {'win-app1': None, 'win-app2': None, 'win-app3': None}
+        ec2_instances = {'win-app{}.{}'.format(i, DOMAIN): instance('win-app{}'.format(i)) for i in range(1, 5)}
+
+        report = reconcile(ds_computers, ec2_instances, match)
+
+        self.assertEqual(report.need_repair, ['win-app1', 'win-app2', 'win-app3'])
+        self.assertEqual(report.unjoined, ['win-app4.{}'.format(DOMAIN)])
+        self.assertEqual(report.joined, [])
+
+    def test_stopped_instance_is_not_repaired(self):
+        match = compile_filters(['win'])
+        ds_computers = {'win-app1': None, 'win-app2': None}
+        ec2_instances = {'win-app1.{}'.format(DOMAIN): instance('win-app1', 'stopped'),
+                         'win-app2.{}'.format(DOMAIN): instance('win-app2')}
+
+        report = reconcile(ds_computers, ec2_instances, match)
+
+        self.assertEqual(report.stopped, ['win-app1'])
+        self.assertEqual(report.need_repair, ['win-app2'])
+        self.assertEqual(report.unjoined, [])
+
+    def test_names_matched_by_no_filter_are_ignored(self):
+        match = compile_filters(['win'])
+        ds_computers = {'nprd-app1': None}
+        ec2_instances = {'nprd-app1.{}'.format(DOMAIN): instance('nprd-app1'),
+                         'nprd-app2.{}'.format(DOMAIN): instance('nprd-app2')}
+
+        self.assertEqual(reconcile(ds_computers, ec2_instances, match), ([], [], [], []))
+        self.assertEqual(reconcile(ds_computers, ec2_instances, compile_filters([])), ([], [], [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()